@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2012 Tai Chi Minh Ralph Eastwood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import argparse
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# modules that read-only commands must never import
+HEAVY_MODULES = ['nltk', 'scipy', 'numpy', 'jellyfish', 'latex', 'requests',
+    'oauth2', 'mendeley_client', 'content.pdf', 'ingest']
+
+LIST_MODULES = '''
+import sys
+import kvasir
+k = kvasir.Kvasir()
+for l in k.list():
+    pass
+k.close()
+print ' '.join(m for m in %r if m in sys.modules)
+''' % HEAVY_MODULES
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def bench_startup(args):
+    # run against a throwaway HOME so that a real library is never touched
+    home = tempfile.mkdtemp()
+    env = dict(os.environ, HOME=home)
+    cmd = [sys.executable, os.path.join(ROOT, 'kvasir.py'), 'list']
+    devnull = open(os.devnull, 'wb')
+    try:
+        # the first run creates the index, which is not what we measure
+        subprocess.check_call(cmd, env=env, stdout=devnull)
+        times = []
+        for i in range(args.repeat):
+            start = time.time()
+            subprocess.check_call(cmd, env=env, stdout=devnull)
+            times.append(time.time() - start)
+        loaded = subprocess.check_output([sys.executable, '-c', LIST_MODULES],
+            env=env, cwd=ROOT).split()
+    finally:
+        devnull.close()
+        shutil.rmtree(home)
+    ms = median(times) * 1000.0
+    print 'list: median %.1fms, min %.1fms over %d runs' % (ms,
+        min(times) * 1000.0, args.repeat)
+    if loaded:
+        sys.exit('error: list imported ' + ', '.join(loaded) + '.')
+    if ms > args.limit:
+        sys.exit('error: list took %.1fms, limit is %.1fms.' % (ms, args.limit))
+
+TITLES = [
+    u'A Relational Model of Data for Large Shared Data Banks',
+    u'The Anatomy of a Large-Scale Hypertextual Web Search Engine',
+    u'Time, Clocks, and the Ordering of Events in a Distributed System',
+    u'Reflections on Trusting Trust',
+    u'MapReduce: Simplified Data Processing on Large Clusters',
+    u'Latent Dirichlet Allocation',
+    u'Distinctive Image Features from Scale-Invariant Keypoints',
+    u'Proceedings of the 12th USENIX Symposium, pp. 113-127, 2008',
+    u'arXiv:1207.0580v1 [cs.NE] 3 Jul 2012']
+
+def bench_titles(args):
+    from content import lexicon
+    from content.pdf import title_score
+    start = time.time()
+    lexicon.get()
+    load = time.time() - start
+    start = time.time()
+    for i in range(args.repeat):
+        for t in TITLES:
+            title_score(t)
+    elapsed = time.time() - start
+    print 'lexicon: loaded %d words in %.1fms' % (len(lexicon.get().words),
+        load * 1000.0)
+    print 'title_score: %.1fus per title over %d titles' % (
+        elapsed * 1e6 / (args.repeat * len(TITLES)), args.repeat * len(TITLES))
+
+SEARCHES = [
+    ('plain', dict()),
+    ('year range', dict(filters={'year': (1990, 2000)})),
+    ('author', dict(filters={'author': u'author1'})),
+    ('sorted by year', dict(sort='-year')),
+    ('facets', dict(facets=('year', 'author', 'journal'))),
+    ('all of it', dict(filters={'year': (1990, None)}, sort='-year',
+        facets=('year', 'author', 'journal')))]
+
+def build_index(path, docs, seed):
+    # synthetic documents: zipf-ish words, a few thousand authors, a few
+    # hundred journals and years over seven decades
+    import random
+    import datetime
+    import whoosh.index
+    from kvasir import create_schema
+    rng = random.Random(seed)
+    vocabulary = [u'w%d' % i for i in range(20000)]
+    ix = whoosh.index.create_in(path, create_schema())
+    w = ix.writer(limitmb=256)
+    start = datetime.datetime(2012, 1, 1)
+    for i in range(docs):
+        words = [vocabulary[min(int(rng.paretovariate(1.0)) - 1, 19999)]
+            for j in range(100)]
+        w.add_document(title=u' '.join(words[:8]), content=u' '.join(words),
+            author=u'author%d' % rng.randrange(3000),
+            journal=u'journal%d' % rng.randrange(300),
+            year=rng.randrange(1950, 2020), sha256=unicode(i),
+            path=u'doc%d.pdf' % i,
+            added=start + datetime.timedelta(minutes=i))
+    w.commit()
+    return ix
+
+def bench_search(args):
+    import whoosh.index
+    from search import LocalSearch
+    path = args.index or tempfile.mkdtemp()
+    try:
+        start = time.time()
+        if whoosh.index.exists_in(path):
+            ix = whoosh.index.open_dir(path)
+        else:
+            ix = build_index(path, args.docs, args.seed)
+            print 'built %d documents in %.1fs' % (args.docs, time.time() - start)
+        searcher = ix.searcher()
+        ls = LocalSearch(ix.schema, lambda: searcher)
+        print 'searching %d documents for %r' % (searcher.doc_count(), args.query)
+        for name, options in SEARCHES:
+            times = []
+            for i in range(args.repeat):
+                ls.cache.clear()
+                start = time.time()
+                hits = ls.search(args.query, 10, **options)
+                times.append(time.time() - start)
+            start = time.time()
+            ls.search(args.query, 10, **options)
+            cached = time.time() - start
+            print '%-16s median %7.1fms, cached %.3fms, %s%d matches' % (name,
+                median(times) * 1000.0, cached * 1000.0,
+                '' if hits.exact else '~', hits.total)
+        searcher.close()
+    finally:
+        if not args.index:
+            shutil.rmtree(path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Kvasir benchmarks.')
+    subparsers = parser.add_subparsers()
+    startup_action = subparsers.add_parser('startup', help='time kvasir.py list and check which modules it imports')
+    startup_action.add_argument('-n', '--repeat', type=int, default=10, help='number of timed runs')
+    startup_action.add_argument('--limit', type=float, default=100.0, help='fail if the median exceeds this many milliseconds')
+    startup_action.set_defaults(func=bench_startup)
+
+    titles_action = subparsers.add_parser('titles', help='time lexicon loading and title scoring')
+    titles_action.add_argument('-n', '--repeat', type=int, default=1000, help='number of passes over the sample titles')
+    titles_action.set_defaults(func=bench_titles)
+
+    search_action = subparsers.add_parser('search', help='time local searches with filters, sorting and facets on a synthetic index')
+    search_action.add_argument('-d', '--docs', type=int, default=100000, help='number of synthetic documents')
+    search_action.add_argument('-n', '--repeat', type=int, default=5, help='number of timed runs of each search')
+    search_action.add_argument('-q', '--query', type=unicode, default=u'w5 w9', help='query to run')
+    search_action.add_argument('--index', type=str, help='keep the synthetic index in this directory and reuse it')
+    search_action.add_argument('--seed', type=int, default=0, help='seed of the synthetic documents')
+    search_action.set_defaults(func=bench_search)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,196 @@
+# Copyright (C) 2012 Tai Chi Minh Ralph Eastwood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import sqlite3
+import binascii
+import itertools
+
+COLUMNS = ('sha256', 'md5sum', 'path', 'title', 'author', 'year', 'journal',
+    'added', 'modified', 'mendeley_id', 'title_tier')
+
+def _value(v):
+    # whoosh stores datetimes, sqlite gets sortable iso strings
+    return v.isoformat() if hasattr(v, 'isoformat') else v
+
+def _migrated(fields, root):
+    # documents indexed before content hashing kept the raw md5 digest and no
+    # sha256; both are taken from the stored file (under root) when it is
+    # still there, they stay in the index as they are until the document is
+    # tagged or added again
+    fields = dict(fields)
+    if fields.get('sha256') is None and root is not None and fields.get('path'):
+        from ingest import hash_file
+        filename = os.path.join(root, fields['path'])
+        if os.path.exists(filename):
+            fields['md5sum'], fields['sha256'] = hash_file(filename)
+    if isinstance(fields.get('md5sum'), str) and len(fields['md5sum']) == 16:
+        fields['md5sum'] = unicode(binascii.hexlify(fields['md5sum']))
+    return fields
+
+class Catalog(object):
+    # The structured metadata of every indexed document, one row each, so that
+    # lookups by hash, path or date are index seeks instead of a walk over
+    # whoosh's stored fields. Changes are staged in an open transaction and
+    # committed right after the whoosh commit they belong to, together with
+    # the index generation; a catalog whose generation does not match the
+    # index (a crash between the two commits, or an index that predates the
+    # catalog) is rebuilt from the stored fields.
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, timeout=30)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS documents (
+            id INTEGER PRIMARY KEY,
+            sha256 TEXT UNIQUE,
+            md5sum TEXT,
+            path TEXT,
+            title TEXT,
+            author TEXT,
+            year INTEGER,
+            journal TEXT,
+            added TEXT,
+            modified TEXT,
+            mendeley_id TEXT,
+            title_tier TEXT)''')
+        for column in ('md5sum', 'path', 'year', 'added'):
+            self.db.execute('CREATE INDEX IF NOT EXISTS documents_%s ON documents (%s)'
+                % (column, column))
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+        # minhash signatures and their lsh buckets (see content.minhash);
+        # they do not come from the index, so a rebuild keeps them
+        self.db.execute('CREATE TABLE IF NOT EXISTS signatures (sha256 TEXT PRIMARY KEY, signature BLOB NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS buckets (band INTEGER, bucket INTEGER, sha256 TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS buckets_bucket ON buckets (band, bucket)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS buckets_sha256 ON buckets (sha256)')
+        self.db.commit()
+
+    def generation(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        return row[0] if row else None
+
+    def put(self, **fields):
+        # staged until commit(); unknown fields are ignored so whoosh's fields
+        # can be passed as they are
+        columns = [c for c in COLUMNS if c in fields]
+        self.db.execute('INSERT OR REPLACE INTO documents (%s) VALUES (%s)' % (
+            ', '.join(columns), ', '.join('?' * len(columns))),
+            [_value(fields[c]) for c in columns])
+
+    def delete(self, sha256):
+        self.db.execute('DELETE FROM documents WHERE sha256 = ?', (sha256,))
+        self.db.execute('DELETE FROM signatures WHERE sha256 = ?', (sha256,))
+        self.db.execute('DELETE FROM buckets WHERE sha256 = ?', (sha256,))
+
+    def put_signature(self, sha256, signature):
+        from content.minhash import buckets
+        self.db.execute('INSERT OR REPLACE INTO signatures (sha256, signature) VALUES (?, ?)',
+            (sha256, sqlite3.Binary(signature)))
+        self.db.execute('DELETE FROM buckets WHERE sha256 = ?', (sha256,))
+        self.db.executemany('INSERT INTO buckets (band, bucket, sha256) VALUES (?, ?, ?)',
+            ((band, bucket, sha256) for band, bucket in buckets(signature)))
+
+    def signature(self, sha256):
+        row = self.db.execute('SELECT signature FROM signatures WHERE sha256 = ?',
+            (sha256,)).fetchone()
+        return str(row[0]) if row else None
+
+    def similar(self, signature, threshold=0.7):
+        # (sha256, similarity) of the documents sharing a bucket with the
+        # signature that are at least threshold similar, most similar first
+        from content.minhash import buckets, similarity
+        candidates = set()
+        for band, bucket in buckets(signature):
+            candidates.update(r[0] for r in self.db.execute(
+                'SELECT sha256 FROM buckets WHERE band = ? AND bucket = ?', (band, bucket)))
+        found = [(c, similarity(signature, self.signature(c))) for c in candidates]
+        return sorted((f for f in found if f[1] >= threshold), key=lambda f: -f[1])
+
+    def near_duplicates(self, threshold=0.7):
+        # every pair of documents that share a bucket and are at least
+        # threshold similar, as (sha256, sha256, similarity); one pass over
+        # the buckets with more than one document
+        from content.minhash import similarity
+        pairs = set()
+        for members, in self.db.execute('SELECT group_concat(sha256, \' \') FROM buckets '
+                'GROUP BY band, bucket HAVING COUNT(*) > 1'):
+            pairs.update(itertools.combinations(sorted(set(members.split())), 2))
+        signatures = {}
+        for a, b in sorted(pairs):
+            for h in (a, b):
+                if h not in signatures:
+                    signatures[h] = self.signature(h)
+            s = similarity(signatures[a], signatures[b])
+            if s >= threshold:
+                yield a, b, s
+
+    def unsigned(self):
+        # documents without a signature, indexed before there were any
+        return self.db.execute('SELECT sha256, path FROM documents WHERE sha256 IS NOT NULL '
+            'AND sha256 NOT IN (SELECT sha256 FROM signatures) ORDER BY path').fetchall()
+
+    def commit(self, generation):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', ?)",
+            (generation,))
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def rebuild(self, searcher, generation, root=None):
+        self.db.execute('DELETE FROM documents')
+        for fields in searcher.all_stored_fields():
+            # pages are indexed as children of their document
+            if 'parent' not in fields:
+                self.put(**_migrated(fields, root))
+        self.commit(generation)
+
+    def get(self, sha256):
+        return self.db.execute('SELECT * FROM documents WHERE sha256 = ?',
+            (sha256,)).fetchone()
+
+    def by_path(self, path):
+        return self.db.execute('SELECT * FROM documents WHERE path = ?',
+            (path,)).fetchone()
+
+    def by_md5(self, md5sum):
+        return self.db.execute('SELECT * FROM documents WHERE md5sum = ?',
+            (md5sum,)).fetchall()
+
+    def added_since(self, when):
+        return self.db.execute('SELECT * FROM documents WHERE added >= ? ORDER BY added',
+            (_value(when),))
+
+    def missing(self, column):
+        # documents without a value for column, e.g. year or mendeley_id
+        assert column in COLUMNS, 'unknown column ' + column
+        return self.db.execute("SELECT * FROM documents WHERE %s IS NULL OR %s = '' ORDER BY path"
+            % (column, column))
+
+    def documents(self, columns=('path', 'title')):
+        return self.db.execute('SELECT %s FROM documents ORDER BY path'
+            % ', '.join(columns))
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+
+    def close(self):
+        self.db.close()
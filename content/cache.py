@@ -0,0 +1,86 @@
+# Copyright (C) 2012 Tai Chi Minh Ralph Eastwood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import zlib
+import cPickle as pickle
+
+class ExtractionCache(object):
+    # Extraction results (info, text, words, title) of a document stored on
+    # disk under its sha256, one compressed pickle per document in a
+    # subdirectory named after the first two hex digits. A hit touches the
+    # entry's mtime so that prune() can evict the least recently used entries
+    # once the cache grows beyond limitmb.
+    def __init__(self, path, limitmb=512):
+        self.path = path
+        self.limitmb = limitmb
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+
+    def __entry(self, key):
+        return self.path + os.sep + key[:2] + os.sep + key
+
+    def get(self, key):
+        filename = self.__entry(key)
+        try:
+            with open(filename, 'rb') as f:
+                entry = pickle.loads(zlib.decompress(f.read()))
+            os.utime(filename, None)
+            return entry
+        except (IOError, OSError, zlib.error, pickle.UnpicklingError, EOFError):
+            return None
+
+    def put(self, key, entry):
+        filename = self.__entry(key)
+        directory = os.path.dirname(filename)
+        if not os.path.exists(directory):
+            try:
+                os.mkdir(directory)
+            except OSError:
+                # another worker got there first
+                pass
+        # write then rename so readers never see a partial entry
+        partname = filename + '.' + str(os.getpid()) + '.part'
+        with open(partname, 'wb') as f:
+            f.write(zlib.compress(pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)))
+        os.rename(partname, filename)
+
+    def prune(self):
+        entries = []
+        size = 0
+        for directory, subdirs, files in os.walk(self.path):
+            for name in files:
+                filename = directory + os.sep + name
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, filename))
+                size += st.st_size
+        limit = self.limitmb * 1024 * 1024
+        entries.sort()
+        for mtime, length, filename in entries:
+            if size <= limit:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            size -= length
@@ -0,0 +1,87 @@
+# Copyright (C) 2012 Tai Chi Minh Ralph Eastwood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sys
+
+# The english words known to wordnet plus the nltk stopwords, built once from
+# the nltk corpora into a sorted word list so that later runs load a plain
+# file into a frozenset instead of loading wordnet itself.
+LEXICON_PATH = os.environ['HOME'] + os.sep + '.kvasir' + os.sep + 'lexicon'
+
+# wordnet's morphy detachment rules, so inflected forms are found as well
+SUFFIXES = [
+    ('s', ''), ('ses', 's'), ('ves', 'f'), ('xes', 'x'), ('zes', 'z'),
+    ('ches', 'ch'), ('shes', 'sh'), ('men', 'man'), ('ies', 'y'),
+    ('es', 'e'), ('es', ''), ('ed', 'e'), ('ed', ''), ('ing', 'e'),
+    ('ing', ''), ('er', ''), ('est', ''), ('er', 'e'), ('est', 'e')]
+
+def build(filename=LEXICON_PATH):
+    from nltk.corpus import wordnet, stopwords
+    words = set()
+    for lemma in wordnet.all_lemma_names():
+        # multi-word lemmas can never match a single word
+        if '_' not in lemma:
+            words.add(lemma.lower())
+    words.update(stopwords.words())
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    partname = filename + '.' + str(os.getpid()) + '.part'
+    with open(partname, 'wb') as f:
+        f.write(u'\n'.join(sorted(words)).encode('utf-8'))
+    os.rename(partname, filename)
+
+class Lexicon(object):
+    def __init__(self, filename=LEXICON_PATH):
+        if not os.path.exists(filename):
+            build(filename)
+        with open(filename, 'rb') as f:
+            self.words = frozenset(f.read().decode('utf-8').split(u'\n'))
+        self.__memo = {}
+
+    def is_word(self, word):
+        try:
+            return self.__memo[word]
+        except KeyError:
+            pass
+        w = word.lower()
+        found = w in self.words or word in self.words
+        if not found:
+            for suffix, ending in SUFFIXES:
+                if w.endswith(suffix) and w[:len(w) - len(suffix)] + ending in self.words:
+                    found = True
+                    break
+        self.__memo[word] = found
+        return found
+
+    def are_words(self, words):
+        return [self.is_word(w) for w in words]
+
+_lexicon = None
+
+def get():
+    # the lexicon shared by everything in this process
+    global _lexicon
+    if _lexicon is None:
+        _lexicon = Lexicon()
+    return _lexicon
+
+if __name__ == "__main__":
+    build(sys.argv[1] if len(sys.argv) > 1 else LEXICON_PATH)
@@ -0,0 +1,81 @@
+# Copyright (C) 2012 Tai Chi Minh Ralph Eastwood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import re
+import zlib
+import struct
+import hashlib
+
+# MinHash signatures estimate the jaccard similarity of the sets of word
+# shingles of two documents (the fraction of equal signature values), and
+# locality sensitive hashing of the signature in bands finds the documents
+# likely to be similar with one lookup per band. With 32 bands of 4 values a
+# pair at similarity s shares a bucket with probability 1 - (1 - s^4)^32:
+# 0.9998 at 0.7, 0.56 at 0.4 and 0.05 at 0.2; candidates are then checked
+# against their signatures.
+SIZE = 128
+BANDS = 32
+SHINGLE = 5
+# a prime above 2^32, the hashes of the permutations are taken modulo it
+PRIME = 4294967311
+
+_permutations = None
+
+def _words(text):
+    return re.findall(r'\w+', text.lower(), re.UNICODE)
+
+def shingles(text, size=SHINGLE):
+    # crc32 of every run of size words (the whole text if it is shorter)
+    words = _words(text)
+    return set(zlib.crc32(u' '.join(words[i:i + size]).encode('utf-8')) & 0xffffffff
+        for i in xrange(max(len(words) - size + 1, 1 if words else 0)))
+
+def signature(text, title=u''):
+    # the signature of the text and title as bytes, None for no words at all
+    import numpy as np
+    global _permutations
+    if _permutations is None:
+        # fixed, so that signatures from different runs compare
+        rng = np.random.RandomState(1)
+        _permutations = (rng.randint(1, 1 << 31, SIZE).astype(np.uint64),
+            rng.randint(0, 1 << 31, SIZE).astype(np.uint64))
+    a, b = _permutations
+    x = np.fromiter(shingles(text) | shingles(title), dtype=np.uint64)
+    if not len(x):
+        return None
+    values = np.empty(SIZE, dtype=np.uint64)
+    values.fill(PRIME)
+    # a chunk at a time keeps the SIZE x n matrix small
+    for i in xrange(0, len(x), 4096):
+        h = (np.outer(a, x[i:i + 4096]) + b[:, None]) % PRIME
+        np.minimum(values, h.min(axis=1), values)
+    return (values & 0xffffffff).astype('<u4').tostring()
+
+def similarity(a, b):
+    import numpy as np
+    return float(np.mean(np.frombuffer(a, dtype='<u4') == np.frombuffer(b, dtype='<u4')))
+
+def buckets(signature, bands=BANDS):
+    # (band, bucket) pairs, bucket being a 64 bit hash of the band's values
+    width = len(signature) // bands
+    return [(band, struct.unpack('<q', hashlib.md5(
+        signature[band * width:(band + 1) * width]).digest()[:8])[0])
+        for band in xrange(bands)]
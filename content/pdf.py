@@ -19,153 +19,327 @@
 # SOFTWARE.
 
 import os
+import re
 import sys
 import subprocess
-import tempfile
-import hashlib
-import warnings
-from HTMLParser import HTMLParser
-from string import lstrip, split, punctuation, maketrans
+import time
+from distutils.spawn import find_executable
+from string import punctuation
 
-from nltk.corpus import wordnet, stopwords
-from scipy.cluster.vq import kmeans2, whiten
+import lexicon
+
+# numpy is slow to import, so it is only loaded once a title actually has to
+# be found
+
+# tool discovery is done once per process
+_commands = {}
 
 def has_command(cmd):
-    devnull = os.open(os.devnull, os.O_RDWR)
-    subprocess.check_call('which ' + cmd + ' && exit 0', stdout=devnull,
-        stderr=devnull, shell=True) == 0, 'pdftotext command not available'
-    os.close(devnull)
+    if cmd not in _commands:
+        _commands[cmd] = find_executable(cmd) is not None
+    return _commands[cmd]
+
+punc2whitespace = dict((ord(c), u' ') for c in punctuation)
 
 def title_score(text):
     score = 0.0
-    text = text.encode('ascii')
-    punc2whitespace = maketrans(punctuation, ' ' * len(punctuation))
-    ws = text.translate(punc2whitespace).split()
+    ws = unicode(text).translate(punc2whitespace).split()
     # must start with capital letter
     if len(ws) == 0 or len(ws[0]) == 0 or not ws[0][0].isupper():
         return 0
-    for word in ws:
-        synset = wordnet.synsets(word)
-        score += 1.0 if len(synset) > 0 or word in stopwords.words() else 0.0
+    score = float(sum(lexicon.get().are_words(ws)))
     score /= len(ws)
     return score
 
-class BBoxHTMLParser(HTMLParser):
-    def handle_decl(self, decl):
-        self.inword = False
-        self.point = []
+def kmeans(obs, centroids, restarts, seed=0, iterations=10):
+    # k-means run from several random starts at once: returns the labels of
+    # every observation for each start as a (restarts, n) array
+    import numpy as np
+    n = len(obs)
+    rs = np.random.RandomState(seed)
+    init = np.array([rs.permutation(n)[:centroids] for r in range(restarts)])
+    code = obs[init]
+    offset = (np.arange(restarts) * centroids)[:, np.newaxis]
+    labels = None
+    for i in range(iterations):
+        dist = ((obs[np.newaxis, :, np.newaxis, :] -
+            code[:, np.newaxis, :, :]) ** 2).sum(axis=3)
+        new_labels = dist.argmin(axis=2)
+        if labels is not None and (new_labels == labels).all():
+            break
+        labels = new_labels
+        # recompute every centroid of every start with one bincount per
+        # dimension, keeping the old centroid of empty clusters
+        flat = (labels + offset).ravel()
+        count = np.bincount(flat, minlength=restarts * centroids)
+        for d in range(obs.shape[1]):
+            total = np.bincount(flat, np.tile(obs[:, d], restarts),
+                restarts * centroids)
+            mean = total / np.maximum(count, 1)
+            code[:, :, d] = np.where(count > 0, mean,
+                code[:, :, d].ravel()).reshape(restarts, centroids)
+    return labels
+
+def cluster_title(points, data, centroids=3, restarts=20, seed=0):
+    # cluster the first words of the page on their geometry and take the
+    # cluster with the widest characters in each run; the most english and
+    # then the longest of those candidates wins
+    import numpy as np
+    if len(data) == 0:
+        return u''
+    points = np.array(points, dtype=float)
+    centroids = min(centroids, len(points))
+    std = points.std(axis=0)
+    std[std == 0] = 1.0
+    labels = kmeans(points / std, centroids, restarts, seed)
+    offset = (np.arange(restarts) * centroids)[:, np.newaxis]
+    flat = (labels + offset).ravel()
+    size = np.bincount(flat, np.tile(points[:, 0], restarts), restarts * centroids)
+    count = np.bincount(flat, minlength=restarts * centroids)
+    avg = np.where(count > 0, size / np.maximum(count, 1), -np.inf)
+    best = avg.reshape(restarts, centroids).argmax(axis=1)
+    scores = {}
+    for mask in set(tuple(m) for m in labels == best[:, np.newaxis]):
+        title = ' '.join([a for (a, b) in zip(data, mask) if b])
+        if title not in scores:
+            scores[title] = title_score(title)
+    # find the most-english longest result
+    top = max(scores.itervalues())
+    return max([t for t in scores if scores[t] == top], key=lambda t: (len(t), t))
+
+def language_score(lang, ymin, window=5):
+    # for every word, how english its neighbourhood on the same line is: the
+    # english words up to window words either side weighted by 1/(distance+1)
+    import numpy as np
+    n = len(lang)
+    width = 2 * window + 1
+    kernel = 1.0 / (np.abs(np.arange(-window, window + 1)) + 1.0)
+    # pad so that every word has a full window, then view the windows as
+    # an (n, width) array and convolve masked by words on the same line
+    lang = np.concatenate((np.zeros(window), np.asarray(lang, dtype=float),
+        np.zeros(window)))
+    line = np.concatenate((np.repeat(np.nan, window), ymin,
+        np.repeat(np.nan, window)))
+    idx = np.arange(n)[:, np.newaxis] + np.arange(width)[np.newaxis, :]
+    same = line[idx] == np.asarray(ymin)[:, np.newaxis]
+    return (lang[idx] * same).dot(kernel) / width
+
+# bumped whenever what PDF.extract returns or how find_title picks a title
+# changes, so that extraction cache entries from before are redone
+EXTRACT_VERSION = 1
+TITLE_VERSION = 1
+
+# a title scoring at least this is taken without trying the next tier
+TITLE_CONFIDENCE = 0.75
+# how much taller than the typical word the title font has to be
+TITLE_FONT_RATIO = 1.2
+
+class TitleStats(object):
+    # how often each tier of find_title produced the title and the time
+    # spent getting there
+    TIERS = ('cache', 'info', 'heuristic', 'cluster')
+
+    def __init__(self):
+        self.hits = dict((t, 0) for t in self.TIERS)
+        self.seconds = dict((t, 0.0) for t in self.TIERS)
+
+    def record(self, tier, seconds):
+        self.hits[tier] += 1
+        self.seconds[tier] += seconds
+
+    def __str__(self):
+        total = sum(self.hits.values())
+        stats = []
+        for t in self.TIERS:
+            if self.hits[t]:
+                stats.append('%s %d%% (%.1fms)' % (t,
+                    100 * self.hits[t] / total,
+                    1000.0 * self.seconds[t] / self.hits[t]))
+        return 'titles: ' + ', '.join(stats)
+
+def heuristic_title(points, data, lines=3):
+    # the first run of up to lines lines set in the largest font, with a
+    # confidence that is zero unless that font stands out from the rest
+    import numpy as np
+    if len(data) < 2:
+        return None, 0.0
+    points = np.asarray(points, dtype=float)
+    height = points[:, 1]
+    ymin = points[:, 2]
+    top = height.max()
+    if top < TITLE_FONT_RATIO * np.median(height):
+        return None, 0.0
+    big = height >= 0.9 * top
+    first = np.flatnonzero(big)[0]
+    chosen = []
+    line = None
+    count = 0
+    for i in range(first, len(data)):
+        if ymin[i] != line:
+            line = ymin[i]
+            count += 1
+            if count > lines or not big[i]:
+                break
+        chosen.append(data[i])
+    title = u' '.join(chosen)
+    return title, title_score(title)
+
+def find_title(words, info=None, stats=None):
+    # tiered: the pdf Title field, then the largest font near the top of the
+    # first page, and only when neither is convincing the clustering ensemble
+    start = time.time()
+    points, data = words
+    info_title = info.get(u'Title') if info else None
+    info_score = title_score(info_title) if info_title else 0.0
+    if info_score >= TITLE_CONFIDENCE and len(info_title.split()) > 1:
+        title, tier = info_title, 'info'
+    else:
+        title, score = heuristic_title(points, data)
+        tier = 'heuristic'
+        if score < TITLE_CONFIDENCE:
+            title = cluster_title(points, data, 3, 20)
+            score = title_score(title)
+            tier = 'cluster'
+        if info_title and info_score >= score:
+            title = info_title
+    if stats is not None:
+        stats.record(tier, time.time() - start)
+    return title, tier
+
+# control characters are not allowed in xml 1.0 but pdftotext writes them as
+# they are in the pdf; in utf-8 they can only ever be these single bytes
+_INVALID_XML = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+class _XMLSafe(object):
+    # a stream with the characters an xml parser rejects left out
+    def __init__(self, stream):
+        self.stream = stream
+
+    def read(self, size=-1):
+        return _INVALID_XML.sub('', self.stream.read(size))
+
+class BBoxParser(object):
+    # Streams the xhtml written by pdftotext -bbox. The geometry of the first
+    # limit words of the first page is kept in numpy arrays for finding the
+    # title, and unless text is False the document metadata and the plain
+    # text of every page are collected too, so one pdftotext run is enough
+    # for everything. Elements are dropped as soon as they have been seen.
+    def __init__(self, limit=40, text=True):
+        import numpy as np
+        self.limit = limit
+        self.keep_text = text
+        self.geometry = np.zeros((limit, 3))
         self.data = []
-        self.lang = []
-        self.lines = []
-        self.line_index = []
-        self.wc = 0
-        self.line = 0
-        self.ymin = 0
-    def handle_starttag(self, tag, attrs):
-        if tag == 'word':
-            self.inword = True
-            xmin = ymin = xmax = ymax = 0
-            for attr in attrs:
-                if attr[0] == 'xmin': xmin = float(attr[1])
-                elif attr[0] == 'ymin': ymin = float(attr[1])
-                elif attr[0] == 'xmax': xmax = float(attr[1])
-                elif attr[0] == 'ymax': ymax = float(attr[1])
-            if self.ymin != ymin:
-                self.line += 1
-                self.lines.append([])
-                self.ymin = ymin
-            self.dim = ((xmax - xmin), (ymax - ymin), ymin, ymax)
-            self.wc += 1
-    def handle_endtag(self, tag):
-        if tag == 'word':
-            self.inword = False
-        elif tag == 'html':
-            for i in range(0, len(self.point)):
-                score = 0.0
-                wpl = 0
-                for j in range(i+5, i-6, -1):
-                    if j >= 0 and j < len(self.lang) and self.point[i][2] == self.point[j][2]:
-                        score += 1.0 / (abs(j-i)+1.0) if self.lang[j] else 0.0
-                        #score += 1.0
-                    wpl += 1
-                self.point[i].append(score/wpl)
-    def handle_data(self, data):
-        if self.inword and self.wc < 40:
-            self.lang.append(len(wordnet.synsets(data)) > 0)
-            self.point.append([(self.dim[0] / len(data)), self.dim[1], self.dim[2]])
-            self.line_index.append(self.line)
-            self.lines[self.line-1].append(data)
+        self.info = {}
+        self.text = []
+        self.textline = []
+        self.page = 0
+        self.ymin = None
+
+    def __end_line(self):
+        if self.textline:
+            self.text.append(u' '.join(self.textline) + u'\n')
+            self.textline = []
+
+    def __word(self, elem):
+        if not elem.text:
+            return
+        data = unicode(elem.text)
+        ymin = float(elem.get('yMin'))
+        if ymin != self.ymin:
+            self.__end_line()
+            self.ymin = ymin
+        if self.keep_text:
+            self.textline.append(data)
+        if self.page == 1 and len(self.data) < self.limit:
+            xmin = float(elem.get('xMin'))
+            xmax = float(elem.get('xMax'))
+            ymax = float(elem.get('yMax'))
+            self.geometry[len(self.data)] = ((xmax - xmin) / len(data),
+                ymax - ymin, ymin)
             self.data.append(data)
 
+    def done(self):
+        # the first page geometry is all that is wanted and it is complete
+        return not self.keep_text and (self.page > 1 or
+            len(self.data) >= self.limit)
+
+    def parse(self, stream):
+        from xml.etree.cElementTree import iterparse
+        page = None
+        for event, elem in iterparse(_XMLSafe(stream), events=('start', 'end')):
+            tag = elem.tag.rsplit('}', 1)[-1]
+            if event == 'start':
+                if tag == 'page':
+                    if self.page > 0:
+                        self.__end_line()
+                        self.text.append(u'\f')
+                    self.page += 1
+                    self.ymin = None
+                    page = elem
+                continue
+            if tag == 'word':
+                self.__word(elem)
+                elem.clear()
+            elif tag == 'page':
+                page.clear()
+            elif tag == 'title':
+                if elem.text and elem.text.strip():
+                    self.info[u'Title'] = unicode(elem.text.strip())
+            elif tag == 'meta':
+                if elem.get('name') and elem.get('content') is not None:
+                    self.info[unicode(elem.get('name'))] = unicode(elem.get('content'))
+            if self.done():
+                break
+        self.__end_line()
+
+    def words(self):
+        # (points, data) where each point is (character width, height, ymin,
+        # language score of the neighbourhood)
+        import numpy as np
+        n = len(self.data)
+        geometry = self.geometry[:n]
+        lang = lexicon.get().are_words(self.data)
+        score = language_score(lang, geometry[:, 2])
+        return np.column_stack((geometry, score)), self.data
+
 class PDF(object):
     def __init__(self, filename):
-        has_command('pdftotext')
-        has_command('pdfinfo')
+        if not has_command('pdftotext'):
+            sys.exit('error: pdftotext command not available.')
         if os.path.exists(filename) and os.path.isfile(filename):
             self.filename = unicode(filename)
         else:
-            sys.exit('error: ' + d + ' is not a file.')
-    def info(self):
-        data = subprocess.check_output(['pdfinfo', '-enc', 'UTF-8', self.filename],
-            stderr=subprocess.STDOUT)
-        result = {}
-        for l in split(data, '\n'):
-            if l.find(':') != -1:
-                f, v = split(l, ':', 1)
-                v = lstrip(v)
-                result[unicode(f, 'utf-8')] = unicode(v, 'utf-8')
-        return result
-    def text(self, first=1, last=-1):
+            sys.exit('error: ' + filename + ' is not a file.')
+    def __parse(self, bp, first=1, last=-1):
         first = ['-f', str(first)]
         last = ['-l', str(last)] if last > 0 else []
-        cmd = ['pdftotext', '-enc', 'UTF-8'] + first + last + [self.filename, '-']
-        data = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        return unicode(data, 'utf-8')
-    def __cluster_title(self, points, data, centroids=3):
-        res, idx = kmeans2(whiten(points), centroids)
-        size = [0] * len(res)
-        count = [0] * len(res)
-        avg = []
-        for i in range(0, len(res)):
-            for a,b in zip(points,idx):
-                if i == b:
-                    size[i] += a[0]
-                    count[i] += 1
-            if count[i] > 0:
-                avg.append(float(size[i]) / float(count[i]))
-        num = avg.index(max(avg))
-        return ' '.join([a for (a,b) in zip(data, idx) if b == num])
-    def __cluster_title2(self, points, data, centroids=3, limit=10):
-        result = []
-        # disable user warnings
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", UserWarning)
-            for i in range(0, limit):
-                title = self.__cluster_title(points, data, centroids)
-                if title not in result:
-                    score = title_score(title)
-                    result.append((title, score))
-        # find the most-english longest result
-        result = sorted(set(result), key=lambda s: s[1], reverse=True)
-        result = [(a,b) for (a,b) in result if b == result[0][1]]
-        return max(result, key=lambda s: len(s[0]))[0]
-    def title(self):
+        cmd = ['pdftotext', '-enc', 'UTF-8', '-bbox'] + first + last + [self.filename, '-']
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        try:
+            bp.parse(p.stdout)
+        except:
+            p.kill()
+            p.wait()
+            raise
+        if bp.done() and p.poll() is None:
+            # stopped early, the rest of the output is not wanted
+            p.kill()
+            p.wait()
+            return
+        if p.wait() != 0:
+            raise subprocess.CalledProcessError(p.returncode, cmd)
+    def extract(self, first=1, last=-1):
+        # metadata, full text and first page words from a single pdftotext
+        # run, parsed straight from its pipe
+        bp = BBoxParser()
+        self.__parse(bp, first, last)
+        return bp.info, u''.join(bp.text), bp.words()
+    def words(self):
+        # geometry and text of the first words on the first page
         assert os.path.exists(self.filename), "error: what happened to the file!"
-        filename = tempfile.mktemp()
-        subprocess.check_call(
-            'pdftotext -enc UTF-8 -bbox -l 1 "' + self.filename + '" '
-            + filename, shell=True)
-        with open(filename, 'rb') as f:
-            text = unicode(''.join(f.readlines()), 'utf-8')
-        bp = BBoxHTMLParser()
-        bp.feed(text)
-        return self.__cluster_title2(bp.point, bp.data, 3, 20)
-    def md5sum(self):
-        m = hashlib.md5()
-        with open(self.filename, 'rb') as f:
-            while True:
-                data = f.read(128)
-                if not data:
-                    break
-                m.update(data)
-        return m.digest()
+        bp = BBoxParser(text=False)
+        self.__parse(bp, 1, 1)
+        return bp.words()
+    def title(self, words=None, info=None):
+        return find_title(words if words is not None else self.words(), info)[0]
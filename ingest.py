@@ -0,0 +1,249 @@
+# Copyright (C) 2012 Tai Chi Minh Ralph Eastwood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import re
+import time
+import fcntl
+import shutil
+import hashlib
+import itertools
+import multiprocessing
+
+from content.cache import ExtractionCache
+from content.pdf import PDF, find_title, EXTRACT_VERSION, TITLE_VERSION
+from content.minhash import signature
+
+BUFFER_SIZE = 1024 * 1024
+# linux ioctl to share extents between files (btrfs, xfs)
+FICLONE = 0x40049409
+
+def _hash_stream(f, out=None):
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    while True:
+        data = f.read(BUFFER_SIZE)
+        if not data:
+            break
+        md5.update(data)
+        sha256.update(data)
+        if out is not None:
+            out.write(data)
+    return unicode(md5.hexdigest()), unicode(sha256.hexdigest())
+
+def hash_file(filename):
+    # (md5sum, sha256) hex digests of a file in one pass
+    with open(filename, 'rb') as f:
+        return _hash_stream(f)
+
+def copy_and_hash(src, dst, link=False):
+    # places src at dst and returns its (md5sum, sha256), reading src only
+    # once; a hard link is used if asked for, otherwise a reflink is tried
+    # before falling back to copying the data as it is hashed
+    if link:
+        try:
+            os.link(src, dst)
+            return hash_file(dst)
+        except OSError:
+            pass
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return _hash_stream(fsrc)
+            except (IOError, OSError):
+                return _hash_stream(fsrc, fdst)
+
+def copy_file(src, dst, link=False):
+    # places src at dst when its hashes are already known, without reading
+    # it more than a copy has to: a hard link if asked for, then a reflink
+    if link:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except (IOError, OSError):
+                shutil.copyfileobj(fsrc, fdst, BUFFER_SIZE)
+
+def walk(top, extensions=('.pdf', '.ps')):
+    # documents below top, lazily and in a stable order
+    for directory, subdirs, files in os.walk(top):
+        subdirs.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in extensions:
+                yield os.path.join(directory, name)
+
+class Manifest(object):
+    # Size, mtime and sha256 of every source file seen by add, so that a
+    # rescan only has to stat files to know which ones are new or changed.
+    # Stored as tab separated lines and rewritten as a whole by save().
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.__dirty = False
+        if os.path.exists(self.filename):
+            with open(self.filename, 'rb') as f:
+                for l in f:
+                    path, size, mtime, sha256 = l.rstrip('\n').split('\t')
+                    self.entries[path.decode('utf-8')] = (int(size), mtime, sha256)
+
+    def unchanged(self, path, st):
+        entry = self.entries.get(path)
+        return entry is not None and entry[0] == st.st_size and \
+            entry[1] == repr(st.st_mtime)
+
+    def record(self, path, st, sha256):
+        self.entries[path] = (st.st_size, repr(st.st_mtime), sha256)
+        self.__dirty = True
+
+    def forget(self, sha256):
+        # drops the files with the given contents, so that adding them
+        # again is not skipped as unchanged
+        paths = [p for p, entry in self.entries.iteritems() if entry[2] == sha256]
+        for path in paths:
+            del self.entries[path]
+        self.__dirty = self.__dirty or bool(paths)
+        return len(paths)
+
+    def save(self):
+        if not self.__dirty:
+            return
+        partname = self.filename + '.' + str(os.getpid()) + '.part'
+        with open(partname, 'wb') as f:
+            for path, (size, mtime, sha256) in self.entries.iteritems():
+                f.write('\t'.join((path.encode('utf-8'), str(size), mtime,
+                    sha256)) + '\n')
+        os.rename(partname, self.filename)
+        self.__dirty = False
+
+# per-process extraction cache, set up by Pipeline
+_cache = None
+
+def _init_worker(cache_path, cache_limitmb):
+    global _cache
+    _cache = ExtractionCache(cache_path, cache_limitmb) if cache_path else None
+
+_YEAR = re.compile(r'(?:19|20)\d\d')
+
+def _year(info):
+    # the year of the pdf's creation date, the best its metadata offers
+    for key in (u'CreationDate', u'ModDate'):
+        m = _YEAR.search(info.get(key, u''))
+        if m:
+            return int(m.group(0))
+    return None
+
+def extract(item):
+    # runs inside a worker process: everything cpu-bound about a document
+    # happens here, and failures are returned rather than raised so that one
+    # bad pdf never takes down the rest of the batch
+    filename, key = item
+    try:
+        entry = _cache.get(key) if _cache is not None and key else None
+        if entry is None or entry.get('extract_version') != EXTRACT_VERSION:
+            # everything else is derived from what pdftotext gave
+            entry = {}
+        changed = False
+        if 'info' not in entry or 'text' not in entry or 'words' not in entry:
+            # one pdftotext run gives all three
+            entry['info'], entry['text'], entry['words'] = PDF(filename).extract()
+            entry['extract_version'] = EXTRACT_VERSION
+            changed = True
+        info = entry['info']
+        # find an appropriate title, again if the heuristics changed since
+        start = time.time()
+        if entry.get('title_version') != TITLE_VERSION:
+            entry['title'], tier = find_title(entry['words'], info)
+            entry['title_version'] = TITLE_VERSION
+            entry.pop('minhash', None)
+            changed = True
+        else:
+            tier = 'cache'
+        elapsed = time.time() - start
+        if 'minhash' not in entry:
+            entry['minhash'] = signature(entry['text'], entry['title'])
+            changed = True
+        if _cache is not None and key and changed:
+            _cache.put(key, entry)
+        author = info[u'Author'] if u'Author' in info else u'Unknown'
+        result = {
+            'title': entry['title'],
+            'author': author,
+            'year': _year(info),
+            'content': entry['text'],
+            'title_tier': tier,
+            'minhash': entry['minhash'],
+            'title_seconds': elapsed,
+            'cache_written': _cache is not None and bool(key) and changed}
+        return filename, result, None
+    except (Exception, SystemExit), e:
+        return filename, None, str(e) or e.__class__.__name__
+
+class Pipeline(object):
+    # The worker pool is started on the first run and kept until close(), so
+    # a long-running process keeps its workers (and their lexicon) warm.
+    def __init__(self, jobs=None, cache_path=None, cache_limitmb=512):
+        self.jobs = jobs if jobs and jobs > 0 else multiprocessing.cpu_count()
+        self.cache_path = cache_path
+        self.cache_limitmb = cache_limitmb
+        self.__pool = None
+
+    def run(self, items):
+        # items are (filename, sha256) pairs, the hash keying the cache;
+        # yields (filename, result, error) in completion order
+        items = list(items)
+        if not items:
+            # a rescan with nothing new starts no workers and prunes nothing
+            return
+        written = False
+        if self.jobs == 1:
+            if self.__pool is None:
+                _init_worker(self.cache_path, self.cache_limitmb)
+                self.__pool = False
+            for r in itertools.imap(extract, items):
+                written = written or (r[1] is not None and r[1]['cache_written'])
+                yield r
+        else:
+            if self.__pool is None:
+                self.__pool = multiprocessing.Pool(self.jobs, _init_worker,
+                    (self.cache_path, self.cache_limitmb))
+            try:
+                for r in self.__pool.imap_unordered(extract, items):
+                    written = written or (r[1] is not None and r[1]['cache_written'])
+                    yield r
+            except:
+                self.__pool.terminate()
+                self.__pool.join()
+                self.__pool = None
+                raise
+        # pruning walks the whole cache, only worth it once it has grown
+        if self.cache_path and written:
+            ExtractionCache(self.cache_path, self.cache_limitmb).prune()
+
+    def close(self):
+        if self.__pool:
+            self.__pool.close()
+            self.__pool.join()
+        self.__pool = None
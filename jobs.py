@@ -0,0 +1,132 @@
+# Copyright (C) 2012 Tai Chi Minh Ralph Eastwood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import time
+import fcntl
+import sqlite3
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+class JobQueue(object):
+    # Documents waiting to be added, kept in sqlite so that the queue
+    # survives crashes: a job is claimed (running) before it is worked on
+    # and only marked done once the index has been committed, and recover()
+    # puts the jobs of a worker that died back in the queue.
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, timeout=30)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            state TEXT NOT NULL,
+            error TEXT,
+            queued REAL NOT NULL,
+            started REAL,
+            finished REAL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)')
+        self.db.commit()
+
+    def put(self, paths):
+        now = time.time()
+        with self.db:
+            self.db.executemany('INSERT INTO jobs (path, state, queued) VALUES (?, ?, ?)',
+                ((p, QUEUED, now) for p in paths))
+
+    def pending(self):
+        # whether there is anything to claim or recover, read only so that
+        # an idle worker polling it does not take the write lock
+        return self.db.execute('SELECT EXISTS (SELECT 1 FROM jobs WHERE state IN (?, ?))',
+            (QUEUED, RUNNING)).fetchone()[0] == 1
+
+    def recover(self):
+        # only safe while holding the WorkerLock
+        with self.db:
+            return self.db.execute('UPDATE jobs SET state = ?, started = NULL WHERE state = ?',
+                (QUEUED, RUNNING)).rowcount
+
+    def claim(self, count):
+        now = time.time()
+        with self.db:
+            jobs = self.db.execute('SELECT id, path FROM jobs WHERE state = ? ORDER BY id LIMIT ?',
+                (QUEUED, count)).fetchall()
+            self.db.executemany('UPDATE jobs SET state = ?, started = ? WHERE id = ?',
+                ((RUNNING, now, i) for i, p in jobs))
+        return jobs
+
+    def finish(self, results):
+        # results are (id, error) pairs, error being None on success
+        now = time.time()
+        with self.db:
+            self.db.executemany('UPDATE jobs SET state = ?, error = ?, finished = ? WHERE id = ?',
+                ((FAILED if e else DONE, e, now, i) for i, e in results))
+
+    def counts(self):
+        counts = dict((s, 0) for s in (QUEUED, RUNNING, DONE, FAILED))
+        for state, count in self.db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state'):
+            counts[state] = count
+        return counts
+
+    def failures(self, limit=10):
+        return self.db.execute('SELECT path, error FROM jobs WHERE state = ? ORDER BY finished DESC LIMIT ?',
+            (FAILED, limit)).fetchall()
+
+    def throughput(self, window=3600):
+        # documents finished per minute over the last window seconds
+        first, last, count = self.db.execute(
+            'SELECT MIN(started), MAX(finished), COUNT(*) FROM jobs WHERE finished > ?',
+            (time.time() - window,)).fetchone()
+        if not count or last <= first:
+            return 0.0
+        return 60.0 * count / (last - first)
+
+    def purge(self):
+        # forget finished jobs, failures are kept until retried
+        with self.db:
+            return self.db.execute('DELETE FROM jobs WHERE state = ?', (DONE,)).rowcount
+
+    def retry(self):
+        with self.db:
+            return self.db.execute('UPDATE jobs SET state = ?, error = NULL, started = NULL, finished = NULL WHERE state = ?',
+                (QUEUED, FAILED)).rowcount
+
+class WorkerLock(object):
+    # at most one process drains the queue at a time
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = None
+
+    def acquire(self, wait=False):
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
@@ -24,62 +24,181 @@ import argparse
 import exceptions
 import os
 import sys
-import shutil
 import datetime
-from ConfigParser import ConfigParser
+import json
+import binascii
 
-import whoosh.index as index
-from whoosh.fields import *
-from whoosh.qparser import QueryParser
-import jellyfish
-
-import latex
-import mendeley_client as mendeley
-from content.pdf import PDF, title_score
+# whoosh, the mendeley client and the extraction pipeline (numpy, the
+# lexicon) are imported where they are first used so that a command only pays
+# for the subsystems it actually needs
 
 class State(object):
+    # Key/value state kept in sqlite, so that concurrent invocations never
+    # see a half written file. Values are anything json can hold (the last
+    # search results, say); setting a key to None removes it. An assignment
+    # is its own transaction, except inside "with state:", where assignments
+    # are held back and written together in one transaction on the way out
+    # (or dropped if the block raised).
     def __init__(self, filename):
-        self.config = ConfigParser()
+        import sqlite3
         self.filename = filename
-        self.__read_config()
-    def __read_config(self):
-        if os.path.exists(self.filename):
-            self.config.read(self.filename)
-            if self.config.has_section('STATE'):
-                return
-        with open(self.filename, 'wb') as configfile:
-            self.config.add_section('STATE')
-            self.config.write(configfile)
+        self.db = sqlite3.connect(filename, timeout=30)
+        # readers never wait for the writer
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.db.commit()
+        self.__pending = {}
+        self.__depth = 0
+    def import_config(self, filename):
+        # the values of a state file from before the sqlite store
+        from ConfigParser import ConfigParser
+        config = ConfigParser()
+        config.read(filename)
+        if config.has_section('STATE'):
+            with self:
+                for key, value in config.items('STATE', True):
+                    self[key] = value
+    def __write(self, items):
+        with self.db:
+            for key, value in items:
+                if value is None:
+                    self.db.execute('DELETE FROM state WHERE key = ?', (key,))
+                else:
+                    self.db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)',
+                        (key, json.dumps(value)))
+    def __enter__(self):
+        self.__depth += 1
+        return self
+    def __exit__(self, type, value, traceback):
+        self.__depth -= 1
+        if self.__depth == 0:
+            pending, self.__pending = self.__pending, {}
+            if type is None and pending:
+                self.__write(pending.iteritems())
+        return False
     def __getitem__(self, key):
-        if self.config.has_option('STATE', key):
-            return self.config.get('STATE', key, True)
-        else:
-            return None
+        if key in self.__pending:
+            return self.__pending[key]
+        row = self.db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
     def __setitem__(self, key, value):
-        assert type(value) is str or type(value) is long or type(value) is int or type(value) is float, 'invalid type for config value'
-        self.config.set('STATE', key, value)
-        with open(self.filename, 'wb') as configfile:
-            self.config.write(configfile)
+        if self.__depth:
+            self.__pending[key] = value
+        else:
+            self.__write([(key, value)])
+    def __delitem__(self, key):
+        self[key] = None
+    def close(self):
+        self.db.close()
+
+def source_path(path):
+    # how a document given to add is identified in the manifest and queue
+    path = os.path.abspath(path)
+    return path if isinstance(path, unicode) else path.decode('utf-8', 'replace')
+
+def job_error(errors, source):
+    # the error of a queued path given the errors of add; a directory fails
+    # if any file in it did
+    if source in errors:
+        return errors[source]
+    failed = sorted(p for p in errors if p.startswith(source + os.sep))
+    if not failed:
+        return None
+    return u'%d files failed, first %s: %s' % (len(failed), failed[0],
+        errors[failed[0]])
 
 class Tree(object):
-    def __init__(self, name, *children):
+    # A trie of slash separated keys, children looked up by name. Only documents
+    # have a title; count is the number of documents at or below a node.
+    def __init__(self, name, title=None):
         self.name = name
-        self.children = list(children)
+        self.title = title
+        self.children = {}
+        self.count = 0
 
     def __str__(self):
         return '\n'.join(self.tree_lines())
 
-    def tree_lines(self):
-        yield self.name
-        last = self.children[-1] if self.children else None
-        for child in self.children:
-            prefix = '`-' if child is last else '+-'
-            for line in child.tree_lines():
+    def insert(self, path, title):
+        node = self
+        node.count += 1
+        for p in path.split('/'):
+            child = node.children.get(p)
+            if child is None:
+                child = node.children[p] = Tree(p)
+            node = child
+            node.count += 1
+        node.title = title or u'untitled'
+
+    def label(self):
+        if self.title is not None:
+            return self.title + u' [' + self.name + u']'
+        return self.name
+
+    def tree_lines(self, depth=None):
+        # lines are generated as they are printed; below depth levels only
+        # the number of documents is shown
+        if depth == 0 and self.children:
+            yield self.label() + u' (' + unicode(self.count) + u' documents)'
+            return
+        yield self.label()
+        names = sorted(self.children)
+        last = names[-1] if names else None
+        for name in names:
+            prefix = '`-' if name == last else '+-'
+            for line in self.children[name].tree_lines(
+                    None if depth is None else depth - 1):
                 yield prefix + line
-                prefix = '  ' if child is last else '| '
+                prefix = '  ' if name == last else '| '
+
+def create_schema():
+    from whoosh.fields import Schema, STORED, DATETIME, TEXT, ID, NUMERIC, \
+        KEYWORD, BOOLEAN
+    # whoosh's schema (basically bibtex fields)
+    return Schema(
+        entry=STORED,
+        added=DATETIME(stored=True, sortable=True),
+        modified=DATETIME(stored=True),
+        title=TEXT(stored=True),
+        path=ID(stored=True),
+        content=TEXT,
+        address=STORED,
+        author=TEXT(stored=True, sortable=True),
+        booktitle=TEXT(stored=True),
+        chapter=NUMERIC,
+        edition=STORED,
+        eprint=STORED,
+        howpublished=STORED,
+        institution=STORED,
+        journal=TEXT(stored=True, sortable=True),
+        month=STORED,
+        notes=TEXT(stored=True),
+        number=STORED,
+        organization=STORED,
+        pages=STORED,
+        publisher=STORED,
+        school=STORED,
+        series=STORED,
+        type=STORED,
+        url=STORED,
+        volume=STORED,
+        year=NUMERIC(stored=True, sortable=True),
+        links=KEYWORD(stored=True, lowercase=True, commas=True, scorable=True),
+        md5sum=ID(stored=True),
+        sha256=ID(stored=True, unique=True),
+        keywords=KEYWORD(scorable=True, commas=True),
+        unpublished=BOOLEAN,
+        # each page is a child document of its paper, with the page text
+        # indexed with positions and stored zlib compressed for snippets
+        kind=ID(stored=True),
+        parent=ID(stored=True),
+        page=NUMERIC(stored=True),
+        pagetext=TEXT(phrase=True),
+        pagetext_z=STORED)
 
 class Kvasir(object):
-    def __init__(self):
+    def __init__(self, **writer_options):
         # create the configuration path
         self.__config_path = os.environ['HOME'] + os.sep + '.kvasir'
         if not os.path.exists(self.__config_path):
@@ -89,168 +208,845 @@ class Kvasir(object):
         self.__doc_path = self.__config_path + os.sep + 'doc'
         if not os.path.exists(self.__doc_path):
             os.mkdir(self.__doc_path)
-        self.__udoc_path = self.__config_path + os.sep + 'doc' + os.sep + 'unknown'
-        if not os.path.exists(self.__udoc_path):
-            os.mkdir(self.__udoc_path)
-        self.__state_path = self.__config_path + os.sep + 'state'
+        self.__cache_path = self.__config_path + os.sep + 'cache'
+        self.__manifest_path = self.__config_path + os.sep + 'manifest'
+        self.__catalog_path = self.__config_path + os.sep + 'catalog'
+        self.__queue_path = self.__config_path + os.sep + 'queue'
+        self.__worker_lock_path = self.__config_path + os.sep + 'worker.lock'
+        self.__state_path = self.__config_path + os.sep + 'state.db'
         self.__state = State(self.__state_path)
-        # create whoosh's schema (basically bibtex fields)
-        self.__schema = Schema(
-            entry=STORED,
-            added=DATETIME(stored=True),
-            modified=DATETIME(stored=True),
-            title=TEXT(stored=True),
-            path=ID(stored=True),
-            content=TEXT,
-            address=STORED,
-            author=TEXT(stored=True),
-            booktitle=TEXT(stored=True),
-            chapter=NUMERIC,
-            edition=STORED,
-            eprint=STORED,
-            howpublished=STORED,
-            institution=STORED,
-            journal=TEXT(stored=True),
-            month=STORED,
-            notes=TEXT(stored=True),
-            number=STORED,
-            organization=STORED,
-            pages=STORED,
-            publisher=STORED,
-            school=STORED,
-            series=STORED,
-            type=STORED,
-            url=STORED,
-            volume=STORED,
-            year=NUMERIC,
-            links=KEYWORD(stored=True, lowercase=True, commas=True, scorable=True),
-            md5sum=STORED,
-            keywords=KEYWORD(scorable=True, commas=True),
-            unpublished=BOOLEAN)
-        # create or load the index
+        old_state_path = self.__config_path + os.sep + 'state'
+        if os.path.exists(old_state_path):
+            self.__state.import_config(old_state_path)
+            os.remove(old_state_path)
+        # create or load the index; it is opened read-only so that commands
+        # which do not modify it never take the write lock
         self.__index_path = self.__config_path + os.sep + 'index'
-        if os.path.exists(self.__index_path):
-            try:
-                self.__index = index.open_dir(self.__index_path)
-            except index.EmptyIndexError:
-                self.__index = index.create_in(self.__index_path, self.__schema)
-        else:
+        if not os.path.exists(self.__index_path):
             os.mkdir(self.__index_path)
-            self.__index = index.create_in(self.__index_path, self.__schema)
-        self.__writer = self.__index.writer()
-        # create a mendeley client
-        self.mendeley = mendeley.create_client()
+        import whoosh.index
+        if whoosh.index.exists_in(self.__index_path):
+            self.__index = whoosh.index.open_dir(self.__index_path, readonly=True)
+        else:
+            self.__index = whoosh.index.create_in(self.__index_path, create_schema())
+        self.__writer_options = writer_options
+        self.__writer = None
+        self.__searcher = None
+        self.__mendeley = None
+        self.__pipeline = None
+        self.__queue = None
+        self.__catalog = None
+        self.__store = None
+        self.__local_search = None
+
+    @property
+    def mendeley(self):
+        # creating the client reads config.json and may prompt for oauth
+        if self.__mendeley is None:
+            import mendeley_client
+            self.__mendeley = mendeley_client.create_client()
+        return self.__mendeley
 
-    def add(self, documents):
+    @property
+    def writer(self):
+        # only mutating commands get here, so only they take the write lock
+        if self.__writer is None:
+            import whoosh.index
+            from writer import BatchWriter
+            index = whoosh.index.open_dir(self.__index_path)
+            # fields added to the schema since the index was created
+            schema = create_schema()
+            missing = [n for n in schema.names() if n not in index.schema]
+            if missing:
+                w = index.writer()
+                for name in missing:
+                    w.add_field(name, schema[name])
+                w.commit()
+            # the catalog commits along with every index commit
+            self.__writer = BatchWriter(index,
+                on_commit=self.catalog.commit, on_cancel=self.catalog.rollback,
+                **self.__writer_options)
+        return self.__writer
+
+    @property
+    def store(self):
+        if self.__store is None:
+            from store import DocumentStore
+            self.__store = DocumentStore(self.__doc_path)
+        return self.__store
+
+    @property
+    def catalog(self):
+        if self.__catalog is None:
+            from catalog import Catalog
+            self.__catalog = Catalog(self.__catalog_path)
+            generation = self.__index.latest_generation()
+            if self.__catalog.generation() != generation:
+                self.__catalog.rebuild(self.searcher, generation, self.__doc_path)
+        return self.__catalog
+
+    @property
+    def searcher(self):
+        # reuse one searcher, refreshing it if the index has changed since
+        if self.__searcher is None:
+            self.__searcher = self.__index.searcher()
+        else:
+            self.__searcher = self.__searcher.refresh()
+        return self.__searcher
+
+    def tune_writer(self, **writer_options):
+        # takes effect from the next batch
+        self.__writer_options.update(writer_options)
+        if self.__writer is not None:
+            for option, value in writer_options.iteritems():
+                setattr(self.__writer, option, value)
+
+    def close(self):
+        if self.__pipeline is not None:
+            self.__pipeline.close()
+            self.__pipeline = None
+        if self.__searcher is not None:
+            self.__searcher.close()
+            self.__searcher = None
+        if self.__writer is not None:
+            self.__writer.close()
+            self.__writer = None
+        if self.__catalog is not None:
+            self.__catalog.close()
+            self.__catalog = None
+        self.__state.close()
+
+    def find(self, sha256):
+        # catalog row of the document with the given content hash, if any
+        return self.catalog.get(sha256)
+
+    def __stage(self, d, link, update, seen):
+        # hash first and skip known documents before copying anything or
+        # doing any extraction work, new ones are then copied without being
+        # read for hashing again; returns the hashes and the library
+        # filename, or the path of the existing copy for a duplicate
+        from ingest import hash_file
+        h = hash_file(d)
+        existing = self.find(h[1])
+        if h[1] in seen or (existing is not None and not update):
+            return h, None, existing['path'] if existing else None
+        seen.add(h[1])
+        # an update extracts again from the copy already in the store, so
+        # that no second copy is left behind
+        if existing is not None and existing['path'] and \
+                os.path.exists(self.store.filename(existing['path'])):
+            return h, self.store.filename(existing['path']), None
+        h, staged = self.store.stage(d, link, h)
+        return h, self.store.filename(self.store.commit(staged, h[1])), None
+
+    def __index_document(self, fields, content):
+        # the paper and, after it, a child document for each page (pdftotext
+        # ends pages with a form feed); replaces what was there for the hash
+        import zlib
+        sha256 = fields['sha256']
+        self.writer.delete_by_term('sha256', sha256)
+        self.writer.delete_by_term('parent', sha256)
+        # documents from before hashing are only known by their path
+        self.writer.delete_by_term('path', fields['path'])
+        pages = [dict(kind=u'page', parent=sha256, page=n, pagetext=text,
+            pagetext_z=zlib.compress(text.encode('utf-8')))
+            for n, text in enumerate(content.split(u'\f'), 1) if text.strip()]
+        self.writer.add_group([dict(fields, kind=u'paper', content=content)] + pages)
+
+    def add(self, documents, jobs=None, optimize=False, update=False, link=False,
+            cache_mb=512, recursive=False):
+        from ingest import Pipeline, Manifest, walk
+        from content.pdf import TitleStats
+        # returns the error for each source path that could not be added
         # deal with a citation
         if len(documents) == 0:
             self.__state['current_filename'] = "$CITATION"
-            return
+            return {}
         # deal with pdfs
+        manifest = Manifest(self.__manifest_path)
+        filenames = []
+        hashes = {}
+        sources = {}
+        seen = set()
+        duplicates = []
+        near = []
+        errors = {}
+        unchanged = 0
         for d in documents:
             try:
                 index = int(d)
                 # check state
                 # find download through gscholar
+                continue
             except exceptions.ValueError:
-                if os.path.exists(d):
-                    shutil.copyfile(d, self.__udoc_path + os.sep + os.path.basename(d))
-                else:
-                    sys.exit('error: ' + d + ' does not exist.')
-                filename = self.__udoc_path + os.sep + os.path.basename(d)
-                pdf = PDF(filename)
+                pass
+            if not os.path.exists(d):
+                print >> sys.stderr, 'error: ' + d + ' does not exist.'
+                errors[source_path(d)] = 'does not exist'
+                continue
+            if os.path.isdir(d):
+                if not recursive:
+                    print >> sys.stderr, 'error: ' + d + ' is a directory, use -r to add it.'
+                    errors[source_path(d)] = 'is a directory'
+                    continue
+                paths = walk(d)
+            else:
+                paths = [d]
+            for path in paths:
+                source = source_path(path)
+                try:
+                    st = os.stat(path)
+                    # rescans only look at new or changed files
+                    if recursive and not update and manifest.unchanged(source, st):
+                        unchanged += 1
+                        continue
+                    h, filename, existing = self.__stage(path, link, update, seen)
+                except (IOError, OSError), e:
+                    print >> sys.stderr, 'error: ' + path + ': ' + str(e)
+                    errors[source] = str(e)
+                    continue
+                if filename is None:
+                    duplicates.append((path, existing))
+                    manifest.record(source, st, h[1])
+                    continue
+                filenames.append(filename)
+                hashes[filename] = h
+                sources[filename] = (source, st)
+        # extraction runs in parallel, everything touching the index or the
+        # state is done here by a single writer
+        added = 0
+        if self.__pipeline is None:
+            self.__pipeline = Pipeline(jobs,
+                self.__cache_path if cache_mb > 0 else None, cache_mb)
+        items = [(f, hashes[f][1]) for f in filenames]
+        title_stats = TitleStats()
+        # the state is written once, when the batch is through
+        with self.__state:
+            for filename, doc, error in self.__pipeline.run(items):
+                if error is not None:
+                    print >> sys.stderr, 'error: ' + sources[filename][0].encode('utf-8') + ': ' + error
+                    # unless indexed before, nothing refers to the copy
+                    if self.find(hashes[filename][1]) is None:
+                        os.remove(filename)
+                    errors[sources[filename][0]] = error
+                    continue
                 self.__state['current_filename'] = filename
-                info = pdf.info()
-                text = pdf.text()
-                # find an appropriate title
-                title = pdf.title()
-                title_score0 = title_score(title)
-                if u'Title' in info:
-                    title_score1 = title_score(info[u'Title'])
-                    if title_score1 >= title_score0:
-                        title = info[u'Title']
-                author = info[u'Author'] if u'Author' in info else u'Unknown'
+                title_stats.record(doc['title_tier'], doc['title_seconds'])
                 # search on mendeley for matching titles
-                results = self.search('title:' + title, count=10)
+                results = self.search('title:' + doc['title'], count=10)
                 print results
 
-                self.__writer.add_document(title=title, author=author,
-                    content=text, type=u'article', md5sum=pdf.md5sum(),
+                # replaces an existing entry and its pages on update
+                md5, sha256 = hashes[filename]
+                fields = dict(title=doc['title'], author=doc['author'],
+                    type=u'article', md5sum=md5, sha256=sha256,
                     added=datetime.datetime.utcnow(), modified=datetime.datetime.utcnow(),
-                    path=os.path.relpath(pdf.filename, self.__doc_path))
-                self.__writer.commit()
-                print title, 'by', author, 'added.'
-
-    def list(self):
-        root = Tree('doc')
-        with self.__index.searcher() as s:
-            for fields in s.all_stored_fields():
-                node = root
-                for p in fields['path'].split('/'):
-                    found = False
-                    for n in root.children:
-                        if n.name == p:
-                            node = n
-                            found = True
+                    path=os.path.relpath(filename, self.__doc_path))
+                year = mendeley_year(results, doc['title']) or doc.get('year')
+                if year is not None:
+                    fields['year'] = year
+                old = self.find(sha256)
+                if old is not None:
+                    self.store.unlink(dict(old))
+                self.catalog.put(title_tier=doc['title_tier'], **fields)
+                self.store.link(fields)
+                # flagged only, a preprint and its published version are
+                # both worth keeping
+                if doc['minhash'] is not None:
+                    for other, similarity in self.catalog.similar(doc['minhash']):
+                        row = self.find(other) if other != sha256 else None
+                        # signatures can outlive their document or its file
+                        if row is not None and row['path']:
+                            near.append((fields['path'], row['path'], similarity))
                             break
-                    if not found:
-                        new_node = Tree(p)
-                        node.children.append(new_node)
-                        node = new_node
-                node.name = fields['title'] + ' [' + node.name + ']'
-        return root.tree_lines()
-
-    def search(self, qs, local=False, count=10):
+                    self.catalog.put_signature(sha256, doc['minhash'])
+                # last, the batch may be committed here and the catalog with
+                # it, which must already have the row
+                self.__index_document(fields, doc['content'])
+                source, st = sources[filename]
+                manifest.record(source, st, sha256)
+                added += 1
+                print doc['title'], 'by', doc['author'], 'added.'
+        if self.__writer is not None:
+            self.__writer.close(optimize)
+        # only once the index has everything the manifest claims
+        manifest.save()
+        if added:
+            print title_stats
+        if duplicates:
+            print str(len(duplicates)) + ' already indexed, skipped:'
+            for d, path in duplicates:
+                print '  ' + d + (' [' + path.encode('utf-8') + ']' if path else ' [duplicate in this batch]')
+        if unchanged:
+            print str(unchanged) + ' unchanged since the last scan.'
+        if near:
+            print str(len(near)) + ' look like near duplicates of indexed documents:'
+            for path, other, similarity in near:
+                print '  %s ~ %s (%.2f)' % (path, other, similarity)
+        if errors:
+            print >> sys.stderr, str(added) + ' added, ' + str(len(errors)) + ' failed.'
+        return errors
+
+    @property
+    def queue(self):
+        from jobs import JobQueue
+        if self.__queue is None:
+            self.__queue = JobQueue(self.__queue_path)
+        return self.__queue
+
+    def enqueue(self, documents, recursive=False):
+        # register documents to be added later by work()
+        from ingest import walk
+        paths = []
+        for d in documents:
+            if os.path.isdir(d):
+                # as add does, work() would otherwise take it in whole
+                if not recursive:
+                    print >> sys.stderr, 'error: ' + d + ' is a directory, use -r to add it.'
+                    continue
+                paths.extend(source_path(p) for p in walk(d))
+            else:
+                paths.append(source_path(d))
+        self.queue.put(paths)
+        return len(paths)
+
+    def work(self, batch=50, batches=None, wait=False, **add_options):
+        # drain the queue a batch at a time; False if another process is
+        # already doing so (and wait is False)
+        from jobs import WorkerLock
+        if not self.queue.pending():
+            return True
+        lock = WorkerLock(self.__worker_lock_path)
+        if not lock.acquire(wait):
+            return False
+        try:
+            # anything still running belongs to a worker that died
+            self.queue.recover()
+            while batches is None or batches > 0:
+                claimed = self.queue.claim(batch)
+                if not claimed:
+                    break
+                errors = self.add([p.encode('utf-8') for i, p in claimed],
+                    recursive=True, **add_options)
+                self.queue.finish((i, job_error(errors, source_path(p)))
+                    for i, p in claimed)
+                if batches is not None:
+                    batches -= 1
+        finally:
+            lock.release()
+        return True
+
+    def spawn_worker(self, jobs=None, cache_mb=512):
+        # a detached kvasir.py work process, logging to ~/.kvasir/worker.log
+        import subprocess
+        cmd = [sys.executable, os.path.abspath(__file__), '-n', 'work',
+            '--wait', '-j', str(jobs or 0), '--cache-mb', str(cache_mb)]
+        with open(os.devnull, 'rb') as devnull:
+            with open(self.__config_path + os.sep + 'worker.log', 'ab') as log:
+                subprocess.Popen(cmd, stdin=devnull, stdout=log,
+                    stderr=subprocess.STDOUT, close_fds=True,
+                    preexec_fn=os.setsid)
+
+    def status(self):
+        counts = self.queue.counts()
+        yield ', '.join(str(counts[s]) + ' ' + s for s in
+            ('queued', 'running', 'done', 'failed'))
+        yield '%.1f documents per minute over the last hour' % self.queue.throughput()
+        for path, error in self.queue.failures():
+            yield 'failed: ' + path + ': ' + (error or '')
+
+    def last_search(self):
+        last = self.__state['last_search']
+        if last is None:
+            return
+        yield u'results for ' + last['query'] + u':'
+        for i, r in enumerate(last['results'], last.get('offset', 0)):
+            yield u'%d. %s [%s]' % (i, r['title'], r['path'])
+
+    def __resolve(self, item):
+        # the catalog row of a document given by its number in the last
+        # search or by its path in the library, the last added one for None
+        if item is None:
+            item = self.__state['current_filename']
+            if item is None:
+                return None
+        try:
+            n = int(item)
+        except ValueError:
+            path = os.path.abspath(item)
+            if path.startswith(self.__doc_path + os.sep):
+                item = os.path.relpath(path, self.__doc_path)
+            return self.catalog.by_path(item)
+        last = self.__state['last_search']
+        if last is None:
+            return None
+        n -= last.get('offset', 0)
+        if not 0 <= n < len(last['results']):
+            return None
+        return self.__row(last['results'][n])
+
+    def __row(self, hit):
+        # documents indexed before hashing have no sha256 in the index, the
+        # catalog has it once rebuilt
+        if hit.get('sha256'):
+            return self.catalog.get(hit['sha256'])
+        return self.catalog.by_path(hit['path']) if hit.get('path') else None
+
+    def tag(self, item, title=None, author=None, year=None):
+        # the content is not stored, so it comes back from extraction (a
+        # cache hit unless the cache was pruned)
+        from ingest import Pipeline
+        row = self.__resolve(item)
+        if row is None:
+            sys.exit('error: no such document ' + str(item) + '.')
+        filename = self.__doc_path + os.sep + row['path']
+        if self.__pipeline is None:
+            self.__pipeline = Pipeline(1, self.__cache_path)
+        for f, doc, error in self.__pipeline.run([(filename, row['sha256'])]):
+            if error is not None:
+                sys.exit('error: ' + filename + ': ' + error)
+        fields = dict(self.searcher.document(sha256=row['sha256']) or
+            self.searcher.document(path=row['path']))
+        fields.update(sha256=row['sha256'], md5sum=row['md5sum'])
+        if title:
+            fields['title'] = title.decode('utf-8')
+        if author:
+            fields['author'] = author.decode('utf-8')
+        if year:
+            fields['year'] = year
+        elif fields.get('year') is None and doc.get('year') is not None:
+            fields['year'] = doc['year']
+        fields['modified'] = datetime.datetime.utcnow()
+        self.store.unlink(dict(row))
+        self.catalog.put(title_tier='tag', **fields)
+        self.store.link(fields)
+        self.__index_document(fields, doc['content'])
+        self.writer.close()
+        print fields['title'], 'by', fields['author'], 'tagged.'
+
+    def remove(self):
+        # the documents of the last search, from the index and the library
+        last = self.__state['last_search']
+        if not last or not last['results']:
+            sys.exit('error: no previous search results to remove.')
+        from ingest import Manifest
+        manifest = Manifest(self.__manifest_path)
+        for r in last['results']:
+            row = self.__row(r)
+            if row is None:
+                continue
+            self.writer.delete_by_term('sha256', row['sha256'])
+            self.writer.delete_by_term('parent', row['sha256'])
+            if row['path']:
+                self.writer.delete_by_term('path', row['path'])
+            self.catalog.delete(row['sha256'])
+            manifest.forget(row['sha256'])
+            if row['path']:
+                self.store.unlink(dict(row))
+                filename = self.__doc_path + os.sep + row['path']
+                if os.path.exists(filename):
+                    os.remove(filename)
+            print row['title'], 'removed.'
+        self.writer.close()
+        manifest.save()
+        self.__state['last_search'] = None
+
+    def dedup(self, threshold=0.7, jobs=None, cache_mb=512):
+        # groups of near duplicates in the whole library; documents indexed
+        # before there were signatures get theirs first, from the extraction
+        # cache where possible
+        from collections import defaultdict
+        from content.minhash import similarity
+        unsigned = self.catalog.unsigned()
+        if unsigned:
+            from ingest import Pipeline
+            if self.__pipeline is None:
+                self.__pipeline = Pipeline(jobs,
+                    self.__cache_path if cache_mb > 0 else None, cache_mb)
+            keys = dict((self.__doc_path + os.sep + path, sha256)
+                for sha256, path in unsigned)
+            for filename, doc, error in self.__pipeline.run(keys.items()):
+                if error is not None:
+                    print >> sys.stderr, 'error: ' + filename + ': ' + error
+                elif doc['minhash'] is not None:
+                    self.catalog.put_signature(keys[filename], doc['minhash'])
+            self.catalog.commit(self.__index.latest_generation())
+        # union-find over the similar pairs
+        parent = {}
+        def find(h):
+            while parent.get(h, h) != h:
+                h = parent[h]
+            return h
+        for a, b, s in self.catalog.near_duplicates(threshold):
+            ra, rb = find(a), find(b)
+            if ra != rb:
+                parent[rb] = ra
+        groups = defaultdict(set)
+        for h in parent.keys() + parent.values():
+            groups[find(h)].add(h)
+        yield str(len(groups)) + ' groups of near duplicates.'
+        for root, members in sorted(groups.iteritems()):
+            first = self.catalog.get(root)
+            signature = self.catalog.signature(root)
+            yield u'%s [%s]' % self.__described(root, first)
+            for h in sorted(members):
+                if h != root:
+                    yield u'  ~ %s [%s] (%.2f)' % (self.__described(h,
+                        self.catalog.get(h)) + (similarity(signature,
+                        self.catalog.signature(h)),))
+
+    def __described(self, sha256, row):
+        # title and path of a catalog row, which may be gone or have no file
+        if row is None:
+            return sha256, u'not in the catalog'
+        return row['title'], row['path'] or u'no file'
+
+    def gc(self, grace=86400):
+        # the documents nothing in the catalog refers to
+        referenced = set(path for path, in self.catalog.documents(('path',)))
+        freed = self.store.gc(referenced, grace)
+        print '%.1f MB freed.' % (freed / (1024.0 * 1024.0))
+
+    def list(self, tree=False, subtree=None, depth=None):
+        # grouped by first author and year as in the by-author/ view, the
+        # library paths being content hashes; subtree is an author or an
+        # author/year of that tree
+        from store import shelf
+        if subtree is not None:
+            subtree = subtree.strip('/')
+            if not isinstance(subtree, unicode):
+                subtree = subtree.decode('utf-8')
+        columns = ('sha256', 'path', 'title', 'author', 'year')
+        rows = []
+        for row in self.catalog.documents(columns):
+            doc = dict(zip(columns, row))
+            key = u'/'.join(shelf(doc))
+            if subtree and not (key + u'/').startswith(subtree + u'/'):
+                continue
+            rows.append((key, doc))
+        rows.sort(key=lambda r: (r[0], r[1]['title']))
+        if not tree:
+            return ((doc['title'] or u'untitled') + u' [' + (doc['path'] or u'') + u']'
+                for key, doc in rows)
+        root = Tree(subtree or u'doc')
+        for key, doc in rows:
+            name = (doc['sha256'] or doc['path'])[:8]
+            key = key[len(subtree) + 1:] if subtree else key
+            root.insert(key + u'/' + name if key else name, doc['title'])
+        return root.tree_lines(depth)
+
+    @property
+    def local_search(self):
+        if self.__local_search is None:
+            from search import LocalSearch
+            self.__local_search = LocalSearch(self.__index.schema,
+                lambda: self.searcher)
+        return self.__local_search
+
+    def __remember(self, qs, hits, offset=0):
+        # kept for list -s and for commands that act on the last search
+        self.__state['last_search'] = {'query': qs, 'offset': offset,
+            'results': hits}
+
+    def search(self, qs, local=False, count=10, boosts=None, filters=None,
+            sort=None, facets=()):
         if local:
-            qp = QueryParser("content", schema=self.__index.schema)
-            q = qp.parse(qs)
-
-            with self.__index.searcher() as s:
-                results = s.search(q, limit=count)
-                for r in results:
-                    print r
-            return results
+            if not isinstance(qs, unicode):
+                qs = qs.decode('utf-8')
+            hits = self.local_search.search(qs, count, boosts, filters,
+                sort, facets)
+            self.__remember(qs, [dict((f, h.get(f)) for f in
+                ('sha256', 'path', 'title')) for h in hits])
+            return hits
         else:
             return self.mendeley.search(qs, items=count)
 
+    def search_hits(self, qs, offset=0, count=10, boosts=None, filters=None,
+            sort=None, fields=None, pages=0):
+        # local hits as they are read, with only the given stored fields (and
+        # score and pages) if fields is given; all of them from offset for a
+        # count of None
+        if not isinstance(qs, unicode):
+            qs = qs.decode('utf-8')
+        seen = []
+        for hit in self.local_search.hits(qs, offset, count, boosts, filters,
+                sort, pages=pages):
+            seen.append(dict((f, hit.get(f)) for f in ('sha256', 'path', 'title')))
+            yield dict((f, hit.get(f)) for f in fields) if fields else hit
+        self.__remember(qs, seen, offset)
+
+def mendeley_year(results, title):
+    # the year of the mendeley document with the same title, if any
+    documents = results.get('documents') if isinstance(results, dict) else None
+    for d in documents or []:
+        if (d.get('title') or u'').strip().lower() == title.strip().lower():
+            try:
+                return int(d.get('year'))
+            except (TypeError, ValueError):
+                pass
+    return None
+
+def writer_options(args):
+    return dict(count=args.batch_size, mb=args.batch_mb,
+        seconds=args.batch_seconds, procs=args.procs, limitmb=args.limitmb,
+        multisegment=args.multisegment)
+
+def boosts(args):
+    # field=weight options
+    boosts = {}
+    for b in args.boost or []:
+        field, sep, weight = b.partition('=')
+        try:
+            boosts[field] = float(weight)
+        except ValueError:
+            sys.exit('error: invalid boost ' + b + ', expected field=weight.')
+    return boosts
+
+def filters(args):
+    filters = {}
+    if args.year:
+        low, sep, high = args.year.partition('-')
+        try:
+            low = int(low) if low else None
+            high = int(high) if high else (None if sep else low)
+        except ValueError:
+            sys.exit('error: invalid year range ' + args.year + '.')
+        filters['year'] = (low, high)
+    if args.author:
+        filters['author'] = args.author.decode('utf-8')
+    if args.journal:
+        filters['journal'] = args.journal.decode('utf-8')
+    if args.since:
+        try:
+            filters['added'] = datetime.datetime.strptime(args.since, '%Y-%m-%d')
+        except ValueError:
+            sys.exit('error: invalid date ' + args.since + ', expected YYYY-MM-DD.')
+    return filters
+
+def _json_value(v):
+    # stored datetimes
+    return v.isoformat()
+
+def _text(v):
+    if v is None:
+        return u''
+    return v if isinstance(v, unicode) else unicode(v)
+
+def run(k, args):
+    # the commands that run either in process or inside the daemon
+    if args.which == 'add' and args.queue:
+        print str(k.enqueue(args.items, args.recursive)) + ' documents queued.'
+    elif args.which == 'add':
+        k.tune_writer(**writer_options(args))
+        k.add(args.items, args.jobs, args.optimize, args.update, args.link,
+            args.cache_mb, args.recursive)
+    elif args.which == 'list':
+        for l in (k.last_search() if args.search else
+                k.list(args.tree, args.subtree, args.depth)):
+            print l.encode('utf-8') if isinstance(l, unicode) else l
+    elif args.which == 'search' and args.local:
+        qs = ' '.join(args.query)
+        if not isinstance(qs, unicode):
+            qs = qs.decode('utf-8')
+        options = dict(boosts=boosts(args), filters=filters(args),
+            sort=('-' if args.reverse else '') + args.sort if args.sort else None)
+        offset = args.offset if args.offset is not None else (args.page - 1) * args.count
+        fields = args.fields.split(',') if args.fields else None
+        for i, h in enumerate(k.search_hits(qs, offset, args.count or None,
+                fields=fields, pages=args.pages, **options), offset):
+            if args.json:
+                if isinstance(h.get('md5sum'), str):
+                    # the raw digest of a document indexed before hashing
+                    h['md5sum'] = binascii.hexlify(h['md5sum'])
+                print json.dumps(h, default=_json_value)
+            elif fields:
+                print u'\t'.join(_text(h[f]) for f in fields).encode('utf-8')
+            else:
+                print (u'%d. %s by %s [%s]' % (i, h.get('title'), h.get('author'),
+                    h.get('path')) + (u' (%.2f)' % h['score']
+                    if h['score'] is not None else u'')).encode('utf-8')
+                for page, snippet in h.get('pages', ()):
+                    print (u'   p. %d: %s' % (page, snippet)).encode('utf-8')
+        if args.facet:
+            # over every match, whatever the page
+            hits = k.local_search.search(qs, 1,
+                facets=args.facet, **options)
+            for field in args.facet:
+                counts = sorted(hits.facets[field].iteritems(),
+                    key=lambda c: -c[1])[:10]
+                line = field + ': ' + u', '.join(u'%s (%d)' % c for c in counts)
+                if args.json:
+                    print json.dumps({'facet': field, 'counts': counts})
+                else:
+                    print line.encode('utf-8')
+    elif args.which == 'search':
+        print k.search(' '.join(args.query), args.local, args.count)
+    elif args.which == 'tag':
+        k.tag(args.item, args.title, args.author, args.year)
+    elif args.which == 'remove':
+        k.remove()
+    elif args.which == 'gc':
+        k.gc(args.grace)
+    elif args.which == 'dedup':
+        for l in k.dedup(args.threshold, args.jobs, args.cache_mb):
+            print l.encode('utf-8')
+    else:
+        sys.exit('error: unknown action ' + args.which)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Bibliography manager.')
+    parser.add_argument('-n', '--no-daemon', action='store_true', help='run the command in this process even if a daemon is running')
     subparsers = parser.add_subparsers()
     add_action = subparsers.add_parser('add', help='add documents from file')
     add_action.add_argument('items', metavar='P', type=str, nargs='*',
             help='list of items to add')
-    #add_action.add_argument('-r', '--recursive', action='store_true', help='recursively add documents in path with extension ps or pdf')
+    add_action.add_argument('-r', '--recursive', action='store_true', help='recursively add documents in path with extension ps or pdf')
+    add_action.add_argument('-j', '--jobs', type=int, default=0, help='number of extraction processes (default: number of cpus)')
+    add_action.add_argument('--batch-size', type=int, default=100, help='commit the index after this many documents (0 to disable)')
+    add_action.add_argument('--batch-mb', type=int, default=0, help='commit the index after this many megabytes of text (0 to disable)')
+    add_action.add_argument('--batch-seconds', type=int, default=0, help='commit the index after this many seconds (0 to disable)')
+    add_action.add_argument('--procs', type=int, default=1, help='number of whoosh indexing processes')
+    add_action.add_argument('--limitmb', type=int, default=128, help='memory limit in megabytes for each whoosh indexing process')
+    add_action.add_argument('--multisegment', action='store_true', help='let each whoosh indexing process write its own segment')
+    add_action.add_argument('--link', action='store_true', help='hard link documents into the library instead of copying them when possible')
+    add_action.add_argument('--cache-mb', type=int, default=512, help='size limit in megabytes of the extraction cache (0 to disable it)')
+    add_action.add_argument('-u', '--update', action='store_true', help='re-index documents that are already indexed instead of skipping them')
+    add_action.add_argument('--optimize', action='store_true', help='merge the index into a single segment when done')
+    add_action.add_argument('-q', '--queue', action='store_true', help='queue the documents and return, a background worker adds them')
     add_action.set_defaults(which='add')
 
+    watch_action = subparsers.add_parser('watch', help='add documents as they appear in directories')
+    watch_action.add_argument('directories', metavar='D', type=str, nargs='+', help='directories to watch')
+    watch_action.add_argument('-r', '--recursive', action='store_true', help='watch subdirectories too')
+    watch_action.add_argument('-s', '--scan', action='store_true', help='first add new or changed documents already in the directories and below')
+    watch_action.add_argument('-d', '--debounce', type=float, default=2.0, help='seconds a file has to be left alone before it is added')
+    watch_action.add_argument('-j', '--jobs', type=int, default=0, help='number of extraction processes (default: number of cpus)')
+    watch_action.add_argument('--cache-mb', type=int, default=512, help='size limit in megabytes of the extraction cache (0 to disable it)')
+    watch_action.set_defaults(which='watch')
+
+    work_action = subparsers.add_parser('work', help='add the queued documents')
+    work_action.add_argument('-b', '--batch', type=int, default=50, help='number of documents taken from the queue at a time')
+    work_action.add_argument('-j', '--jobs', type=int, default=0, help='number of extraction processes (default: number of cpus)')
+    work_action.add_argument('--cache-mb', type=int, default=512, help='size limit in megabytes of the extraction cache (0 to disable it)')
+    work_action.add_argument('-w', '--wait', action='store_true', help='wait for another worker to finish instead of exiting')
+    work_action.set_defaults(which='work')
+
+    status_action = subparsers.add_parser('status', help='print the state of the queue')
+    status_action.add_argument('--retry', action='store_true', help='queue failed documents again')
+    status_action.add_argument('--purge', action='store_true', help='forget documents that have been added')
+    status_action.set_defaults(which='status')
+
+    serve_action = subparsers.add_parser('serve', help='run a daemon that add, search, list, tag and remove are handed to')
+    serve_action.set_defaults(which='serve')
+
     tag_action = subparsers.add_parser('tag', help='tag details of the document')
     tag_action.add_argument('item', metavar='I', type=str, nargs='?', help='path or index to tag')
     tag_action.add_argument('-t', '--title', type=str, default='', help='title metadata')
     tag_action.add_argument('-a', '--author', type=str, default='', help='author metadata')
+    tag_action.add_argument('-y', '--year', type=int, default=None, help='year metadata')
     tag_action.set_defaults(which='tag')
 
     remove_action = subparsers.add_parser('remove', help='remove local documents from previous search')
     remove_action.set_defaults(which='remove')
 
+    dedup_action = subparsers.add_parser('dedup', help='report groups of near duplicate documents')
+    dedup_action.add_argument('-t', '--threshold', type=float, default=0.7, help='estimated fraction of shared text shingles that makes a near duplicate')
+    dedup_action.add_argument('-j', '--jobs', type=int, default=0, help='number of extraction processes for documents without a signature (default: number of cpus)')
+    dedup_action.add_argument('--cache-mb', type=int, default=512, help='size limit in megabytes of the extraction cache (0 to disable it)')
+    dedup_action.set_defaults(which='dedup')
+
+    gc_action = subparsers.add_parser('gc', help='delete stored documents that are no longer indexed')
+    gc_action.add_argument('-g', '--grace', type=int, default=86400, help='keep documents stored in the last this many seconds')
+    gc_action.set_defaults(which='gc')
+
     search_action = subparsers.add_parser('search', help='search the locally/web for documents')
     search_action.add_argument('query', metavar='Q', type=str, nargs='+', help='search terms')
     search_action.add_argument('-l', '--local', action='store_true', help='search locally rather than on the web')
-    search_action.add_argument('-c', '--count', type=int, default=10, help='how many search results to return')
+    search_action.add_argument('-c', '--count', type=int, default=10, help='how many search results to return (0 for all local ones)')
+    search_action.add_argument('-b', '--boost', action='append', metavar='FIELD=WEIGHT', help='weight of matches in a field for local searches (title, author, journal, keywords, notes, content)')
+    search_action.add_argument('-y', '--year', type=str, help='only documents from this year or range of years (2001, 2001-2010, 2001-, -2010)')
+    search_action.add_argument('-a', '--author', type=str, help='only documents by this author')
+    search_action.add_argument('-j', '--journal', type=str, help='only documents from this journal')
+    search_action.add_argument('--since', type=str, help='only documents added since this date (YYYY-MM-DD)')
+    search_action.add_argument('-s', '--sort', choices=('year', 'added'), help='sort by a field instead of relevance')
+    search_action.add_argument('-r', '--reverse', action='store_true', help='sort in descending order')
+    search_action.add_argument('-f', '--facet', action='append', choices=('year', 'author', 'journal'), help='count the matches for each value of a field')
+    search_action.add_argument('-p', '--page', type=int, default=1, help='page of local results to print, count results per page')
+    search_action.add_argument('-o', '--offset', type=int, help='number of local results to skip instead of a page')
+    search_action.add_argument('--fields', type=str, help='comma separated stored fields to print for local results (and score)')
+    search_action.add_argument('--json', action='store_true', help='print local results as json, one per line')
+    search_action.add_argument('--pages', type=int, default=1, help='number of matching pages to show with a snippet for each local result (0 for none)')
     search_action.set_defaults(which='search')
 
     list_action = subparsers.add_parser('list', help='print out information')
     list_action.add_argument('-s', '--search', action='store_true', help='print last search result')
+    list_action.add_argument('subtree', metavar='S', type=str, nargs='?', help='only list documents of this author or author/year')
     list_action.add_argument('-t', '--tree', action='store_true', help='print out tree of all indexed files')
+    list_action.add_argument('-d', '--depth', type=int, default=None, help='only print the tree this many levels deep')
     list_action.set_defaults(which='list')
 
     args = parser.parse_args()
+    if args.which == 'search':
+        if args.page < 1:
+            search_action.error('argument -p/--page: must be at least 1')
+        if args.offset is not None and args.offset < 0:
+            search_action.error('argument -o/--offset: must not be negative')
+        if args.count < 0:
+            search_action.error('argument -c/--count: must not be negative')
+
+    if not args.no_daemon:
+        import server
+    if not args.no_daemon and args.which in server.COMMANDS:
+        if args.which == 'add':
+            # the daemon does not share our working directory
+            args.items = [os.path.abspath(i) if os.path.exists(i) else i
+                for i in args.items]
+        elif args.which == 'tag' and args.item and os.path.exists(args.item):
+            args.item = os.path.abspath(args.item)
+        status = server.forward(args)
+        if status is not None:
+            sys.exit(status)
 
-    k = Kvasir()
     if args.which == 'add':
-        k.add(args.items)
-    elif args.which == 'list':
-        for l in k.list():
+        k = Kvasir(**writer_options(args))
+        run(k, args)
+        if args.queue:
+            k.spawn_worker(args.jobs, args.cache_mb)
+    elif args.which == 'work':
+        k = Kvasir()
+        if not k.work(args.batch, wait=args.wait, jobs=args.jobs,
+                cache_mb=args.cache_mb):
+            print 'another worker is draining the queue.'
+    elif args.which == 'status':
+        k = Kvasir()
+        if args.retry:
+            print str(k.queue.retry()) + ' failed documents queued again.'
+        if args.purge:
+            print str(k.queue.purge()) + ' finished documents forgotten.'
+        for l in k.status():
             print l
-    elif args.which == 'search':
-        print k.search(' '.join(args.query), args.local, args.count)
+    elif args.which == 'watch':
+        from watch import Watcher
+        k = Kvasir()
+        if args.scan:
+            k.add(args.directories, args.jobs, cache_mb=args.cache_mb,
+                recursive=True)
+        try:
+            Watcher(k, args.directories, args.recursive, args.debounce,
+                jobs=args.jobs, cache_mb=args.cache_mb).run()
+        except KeyboardInterrupt:
+            pass
+    elif args.which == 'serve':
+        import server
+        k = Kvasir()
+        try:
+            # the daemon drains the queue between requests
+            server.serve(k, run, lambda: k.work(batches=1))
+        except KeyboardInterrupt:
+            pass
+    elif args.which in ('list', 'search', 'tag', 'remove', 'gc', 'dedup'):
+        k = Kvasir()
+        run(k, args)
     else:
         sys.exit('error: unknown action ' + args.which)
+    k.close()
@@ -0,0 +1,293 @@
+# Copyright (C) 2012 Tai Chi Minh Ralph Eastwood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import zlib
+import calendar
+import datetime
+import collections
+
+# how much a match in each field counts, relative to one in the full text
+BOOSTS = {'title': 4.0, 'author': 3.0, 'keywords': 2.0, 'journal': 1.5,
+    'notes': 1.5, 'content': 1.0}
+
+class LRUCache(object):
+    def __init__(self, size=64):
+        self.size = size
+        self.items = collections.OrderedDict()
+
+    def get(self, key):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            return None
+        self.items[key] = value
+        return value
+
+    def put(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+class Hits(list):
+    # the stored fields and score of each hit, the number of matching
+    # documents for each value of the faceted fields and the number of
+    # matches, which unless exact is whoosh's estimate
+    def __init__(self, hits, facets=None, total=0, exact=True):
+        list.__init__(self, hits)
+        self.facets = facets or {}
+        self.total = total
+        self.exact = exact
+
+def _key(d):
+    return tuple(sorted(d.iteritems())) if d else ()
+
+def _sort_key(v):
+    if v is None:
+        return -(1 << 63)
+    if isinstance(v, datetime.datetime):
+        return calendar.timegm(v.utctimetuple()) * 1000000 + v.microsecond
+    return int(v)
+
+class _Formatter(object):
+    # marks the matched terms of a snippet as [term]
+    def __call__(self, text, fragments):
+        return u' ... '.join(self.format_fragment(f) for f in fragments)
+
+    def format_fragment(self, fragment):
+        text = fragment.text
+        out = []
+        index = fragment.startchar
+        for t in fragment.matches:
+            out.append(text[index:t.startchar])
+            out.append(u'[' + text[t.startchar:t.endchar] + u']')
+            index = t.endchar
+        out.append(text[index:fragment.endchar])
+        return u''.join(out).replace(u'\n', u' ').strip()
+
+class LocalSearch(object):
+    # Searches title, author, journal, keywords, notes and content at once,
+    # weighted by boosts. The searcher comes from get_searcher() (Kvasir keeps
+    # one open and refreshed), parsers are kept per set of boosts and results
+    # are cached until the index generation changes, so repeating or going
+    # back to a query does not touch the index at all. Facet counts come from
+    # the sortable columns, loaded once per generation.
+    def __init__(self, schema, get_searcher, cache_size=64):
+        self.schema = schema
+        self.get_searcher = get_searcher
+        self.cache = LRUCache(cache_size)
+        self.generation = None
+        self.__parsers = {}
+        self.__columns = {}
+        self.__page_parser = None
+
+    def parser(self, boosts):
+        from whoosh.qparser import MultifieldParser
+        key = tuple(sorted(boosts.iteritems()))
+        parser = self.__parsers.get(key)
+        if parser is None:
+            fields = [f for f in sorted(boosts) if f in self.schema]
+            parser = self.__parsers[key] = MultifieldParser(fields,
+                schema=self.schema, fieldboosts=boosts)
+        return parser
+
+    def filter(self, filters):
+        # filters maps year to a (low, high) range, either end None for open,
+        # author and journal to words that must appear in them and added to
+        # the earliest datetime
+        from whoosh import query
+        terms = []
+        if filters.get('year'):
+            low, high = filters['year']
+            terms.append(query.NumericRange('year', low, high))
+        for field in ('author', 'journal'):
+            if filters.get(field):
+                words = list(self.schema[field].process_text(filters[field], mode='query'))
+                # nothing to filter on if the analyzer drops every word
+                if words:
+                    terms.append(query.And([query.Term(field, w) for w in words]))
+        if filters.get('added'):
+            terms.append(query.DateRange('added', filters['added'], None))
+        return query.And(terms) if terms else None
+
+    def __values(self, searcher, field):
+        # the value of field for every docnum, a segment at a time: from the
+        # column where the segment has one, from the stored fields where it
+        # does not (an index from before the field was sortable)
+        values = [None] * searcher.doc_count_all()
+        for reader, base in searcher.reader().leaf_readers():
+            if reader.has_column(field):
+                column = reader.column_reader(field)
+                for docnum in xrange(reader.doc_count_all()):
+                    values[base + docnum] = column[docnum]
+            else:
+                for docnum in xrange(reader.doc_count_all()):
+                    if not reader.is_deleted(docnum):
+                        values[base + docnum] = reader.stored_fields(docnum).get(field)
+        return values
+
+    def __column(self, searcher, field):
+        # the values of a field as codes into a list of distinct values, read
+        # once per index generation
+        column = self.__columns.get(field)
+        if column is None:
+            import numpy
+            values = []
+            index = {}
+            codes = numpy.empty(searcher.doc_count_all(), dtype=numpy.int32)
+            for docnum, v in enumerate(self.__values(searcher, field)):
+                code = index.get(v)
+                if code is None:
+                    code = index[v] = len(values)
+                    values.append(v)
+                codes[docnum] = code
+            column = self.__columns[field] = (values, codes)
+        return column
+
+    def __sort_keys(self, searcher, field):
+        # the values of a field as integers that sort like them, documents
+        # without a value first
+        keys = self.__columns.get((field, 'keys'))
+        if keys is None:
+            import numpy
+            keys = self.__columns[(field, 'keys')] = numpy.array(
+                [_sort_key(v) for v in self.__values(searcher, field)],
+                dtype=numpy.int64)
+        return keys
+
+    def facet_counts(self, searcher, docs, facets):
+        # the number of documents in docs for each value of each field
+        import numpy
+        counts = {}
+        for field in facets:
+            values, codes = self.__column(searcher, field)
+            n = numpy.bincount(codes[docs], minlength=len(values))
+            # documents without the field have an empty value
+            counts[field] = dict((values[i], int(n[i]))
+                for i in numpy.flatnonzero(n) if values[i])
+        return counts
+
+    def __matches(self, qs, limit, boosts, filters, sort, facets):
+        # the docnums and scores of the first limit matches (every match for
+        # None) with the facet counts and total; these are what is cached,
+        # stored fields are only read as hits are used
+        import numpy
+        from whoosh import query
+        boosts = dict(BOOSTS, **boosts) if boosts else BOOSTS
+        searcher = self.get_searcher()
+        generation = searcher.reader().generation()
+        if generation != self.generation:
+            self.cache.clear()
+            self.__columns = {}
+            self.generation = generation
+        key = (qs, limit, _key(boosts), _key(filters), sort, tuple(facets))
+        matches = self.cache.get(key)
+        if matches is not None:
+            return searcher, matches
+        # papers only, not their pages; documents from before pages have no
+        # kind and are papers
+        q = query.AndNot(self.parser(boosts).parse(qs), query.Term('kind', u'page'))
+        f = self.filter(filters or {})
+        if f is not None:
+            # intersecting in the query lets the matcher skip ahead, which a
+            # whoosh filter does not; every hit gets the same constant added
+            # to its score, so the ranking is unchanged
+            q = query.And([q, query.ConstantScoreQuery(f)])
+        if sort or facets:
+            docs = numpy.fromiter(searcher.docs_for_query(q), dtype=numpy.int64)
+            total, exact = len(docs), True
+        if sort:
+            keys = self.__sort_keys(searcher, sort.lstrip('-'))[docs]
+            order = numpy.argsort(keys, kind='mergesort')
+            if sort.startswith('-'):
+                order = order[::-1]
+            docnums, scores = docs[order[:limit]].tolist(), None
+        else:
+            # the same top n query search_page runs, so an offset need not
+            # fall on a page boundary
+            results = searcher.search(q, limit=limit)
+            docnums = [results.docnum(i) for i in xrange(results.scored_length())]
+            scores = [results.score(i) for i in xrange(results.scored_length())]
+            if not facets:
+                # counting every match would cost as much as the search, and
+                # with whoosh's skipping even has_exact_length() is not
+                # to be trusted
+                total, exact = results.estimated_length(), False
+        matches = (docnums, scores, self.facet_counts(searcher, docs, facets)
+            if facets else {}, total, exact)
+        self.cache.put(key, matches)
+        return searcher, matches
+
+    def pages(self, searcher, sha256, qs, count=1, surround=40):
+        # the best matching pages of a document, as (page number, snippet)
+        # from the indexed and stored page text, without going near the pdf
+        from whoosh import query, highlight
+        from whoosh.qparser import QueryParser
+        if 'pagetext' not in searcher.schema:
+            # an index from before pages, until a writer adds the fields
+            return []
+        if self.__page_parser is None:
+            self.__page_parser = QueryParser('pagetext', schema=searcher.schema)
+        q = self.__page_parser.parse(qs)
+        terms = set(t for f, t in q.iter_all_terms() if f == 'pagetext')
+        field = searcher.schema['pagetext']
+        pages = []
+        for hit in searcher.search(query.And([query.Term('parent', sha256), q]),
+                limit=count):
+            text = zlib.decompress(hit['pagetext_z']).decode('utf-8')
+            snippet = highlight.highlight(text, terms, field.analyzer,
+                highlight.ContextFragmenter(surround=surround), _Formatter(),
+                top=1)
+            pages.append((hit['page'], snippet))
+        return pages
+
+    def hits(self, qs, offset=0, count=10, boosts=None, filters=None, sort=None,
+            fields=None, pages=0):
+        # a generator of the stored fields (only those in fields, if given)
+        # and score of count hits from offset on, every hit from offset for a
+        # count of None; stored fields are read one hit at a time. With pages,
+        # each hit also has the numbers and snippets of up to that many of its
+        # best matching pages.
+        limit = offset + count if count is not None else None
+        searcher, (docnums, scores, counts, total, exact) = self.__matches(qs,
+            limit, boosts, filters, sort, ())
+        for i in xrange(offset, len(docnums)):
+            hit = searcher.stored_fields(docnums[i])
+            hit['score'] = scores[i] if scores is not None else None
+            if pages and hit.get('sha256'):
+                hit['pages'] = self.pages(searcher, hit['sha256'], qs, pages)
+            if fields is not None:
+                hit = dict((f, hit.get(f)) for f in fields)
+            yield hit
+
+    def search(self, qs, count=10, boosts=None, filters=None, sort=None,
+            facets=()):
+        # sort is year or added, descending with a leading -; sorting and
+        # facet counts work on every match with the columns of the fields
+        # (kept as arrays), sorted hits have no score
+        searcher, (docnums, scores, counts, total, exact) = self.__matches(qs,
+            count, boosts, filters, sort, facets)
+        return Hits([dict(searcher.stored_fields(d),
+            score=scores[i] if scores is not None else None)
+            for i, d in enumerate(docnums)], counts, total, exact)
@@ -0,0 +1,139 @@
+# Copyright (C) 2012 Tai Chi Minh Ralph Eastwood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sys
+import json
+import signal
+import socket
+import argparse
+
+# A kvasir.py serve process keeps one Kvasir (index, searcher, writer,
+# extraction workers, mendeley client) open and runs commands sent to it over
+# a unix socket; each request and response is one line of json.
+SOCKET_PATH = os.environ['HOME'] + os.sep + '.kvasir' + os.sep + 'socket'
+
+# the commands a client hands over to a running daemon
+COMMANDS = ('add', 'search', 'list', 'tag', 'remove')
+
+def _connect(path):
+    if not os.path.exists(path):
+        return None
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except socket.error:
+        s.close()
+        return None
+    return s
+
+def forward(args, path=SOCKET_PATH):
+    # runs the command in the daemon and returns its exit status, or None
+    # when no daemon is listening and the command has to run in process
+    s = _connect(path)
+    if s is None:
+        return None
+    try:
+        f = s.makefile('rwb')
+        f.write(json.dumps(vars(args)) + '\n')
+        f.flush()
+        line = f.readline()
+    finally:
+        s.close()
+    if not line:
+        print >> sys.stderr, 'error: the kvasir daemon closed the connection.'
+        return 1
+    response = json.loads(line)
+    sys.stdout.write(response['stdout'].encode('utf-8'))
+    sys.stderr.write(response['stderr'].encode('utf-8'))
+    return response['status']
+
+def _text(s):
+    return s if isinstance(s, unicode) else unicode(s, 'utf-8', 'replace')
+
+def _native(v):
+    # json gives unicode, the commands expect utf-8 strings as argv has them
+    if isinstance(v, unicode):
+        return v.encode('utf-8')
+    if isinstance(v, list):
+        return [_native(x) for x in v]
+    return v
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def serve(k, run, idle=None, path=SOCKET_PATH, timeout=1.0):
+    # handles one request at a time with run(k, args), which prints the
+    # output of the command as the command line would; idle() is called
+    # between requests and at least every timeout seconds
+    import SocketServer
+    import StringIO
+    import traceback
+
+    class Handler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = argparse.Namespace(**dict((k, _native(v))
+                for k, v in json.loads(line).iteritems()))
+            out = StringIO.StringIO()
+            err = StringIO.StringIO()
+            stdout, stderr = sys.stdout, sys.stderr
+            sys.stdout, sys.stderr = out, err
+            status = 0
+            try:
+                run(k, args)
+            except SystemExit, e:
+                if isinstance(e.code, int) or e.code is None:
+                    status = e.code or 0
+                else:
+                    print >> err, e.code
+                    status = 1
+            except Exception:
+                traceback.print_exc(file=err)
+                status = 1
+            finally:
+                sys.stdout, sys.stderr = stdout, stderr
+            self.wfile.write(json.dumps({
+                'stdout': _text(out.getvalue()),
+                'stderr': _text(err.getvalue()),
+                'status': status}) + '\n')
+
+    s = _connect(path)
+    if s is not None:
+        s.close()
+        sys.exit('error: a kvasir daemon is already listening on ' + path + '.')
+    if os.path.exists(path):
+        # left behind by a daemon that did not shut down cleanly
+        os.remove(path)
+    server = SocketServer.UnixStreamServer(path, Handler)
+    os.chmod(path, 0600)
+    # stop on a plain kill the same way as on ^C
+    signal.signal(signal.SIGTERM, _interrupt)
+    server.timeout = timeout
+    try:
+        while True:
+            server.handle_request()
+            if idle is not None:
+                idle()
+    finally:
+        server.server_close()
+        os.remove(path)
@@ -0,0 +1,159 @@
+# Copyright (C) 2012 Tai Chi Minh Ralph Eastwood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import re
+import time
+import errno
+
+_UNSAFE = re.compile(r'[/\\\x00-\x1f]+')
+
+def _name(s, limit=80):
+    # a string made safe to use as one path component
+    s = _UNSAFE.sub(u' ', s or u'').strip(u' .')
+    return s[:limit].strip() or u'unknown'
+
+def shelf(doc):
+    # the first author and the year a document is filed under in the views
+    year = unicode(doc['year']) if doc.get('year') else u'unknown'
+    return _name((doc.get('author') or u'').split(u',')[0]), year
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+class DocumentStore(object):
+    # Documents stored under their sha256, sharded as objects/ab/cd/<sha256>
+    # plus the original extension, so that equal documents are stored once,
+    # different documents never collide and no directory grows large. Paths
+    # are relative to root, which is what the index keeps. by-author/ and
+    # by-year/ hold symlinks into objects/ named after the documents.
+    VIEWS = ('by-author', 'by-year')
+
+    def __init__(self, root):
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        self.tmp = os.path.join(root, 'tmp')
+
+    def path(self, sha256, ext=''):
+        return os.path.join('objects', sha256[:2], sha256[2:4], sha256 + ext.lower())
+
+    def filename(self, path):
+        return os.path.join(self.root, path)
+
+    def stage(self, src, link=False, hashes=None):
+        # copy (or link) src into tmp/ and hash it, unless its hashes are
+        # given; returns the hashes and the staged filename, for commit() or
+        # discard()
+        from ingest import copy_and_hash, copy_file
+        if not os.path.exists(self.tmp):
+            os.makedirs(self.tmp)
+        staged = os.path.join(self.tmp, str(os.getpid()) + '-' + os.path.basename(src))
+        try:
+            if hashes is not None:
+                copy_file(src, staged, link)
+                return hashes, staged
+            return copy_and_hash(src, staged, link), staged
+        except:
+            if os.path.exists(staged):
+                os.remove(staged)
+            raise
+
+    def commit(self, staged, sha256):
+        # moves a staged document to its place, returns its path
+        path = self.path(sha256, os.path.splitext(staged)[1])
+        filename = self.filename(path)
+        if os.path.exists(filename):
+            os.remove(staged)
+        else:
+            if not os.path.exists(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            os.rename(staged, filename)
+        return path
+
+    def discard(self, staged):
+        os.remove(staged)
+
+    def __views(self, doc):
+        # the symlinks of a document given by its stored fields
+        ext = os.path.splitext(doc['path'])[1]
+        name = _name(doc.get('title')) + u' [' + doc['sha256'][:8] + u']' + ext
+        author, year = shelf(doc)
+        # encoded explicitly, the implicit ascii codec fails on most titles
+        return [os.path.join(u'by-author', author, name).encode('utf-8'),
+            os.path.join(u'by-year', year, name).encode('utf-8')]
+
+    def link(self, doc):
+        for view in self.__views(doc):
+            filename = self.filename(view)
+            directory = os.path.dirname(filename)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            if os.path.lexists(filename):
+                os.remove(filename)
+            target = self.filename(doc['path'].encode('utf-8'))
+            os.symlink(os.path.relpath(target, directory), filename)
+
+    def unlink(self, doc):
+        for view in self.__views(doc):
+            filename = self.filename(view)
+            if os.path.lexists(filename):
+                os.remove(filename)
+            try:
+                os.removedirs(os.path.dirname(filename))
+            except OSError:
+                pass
+
+    def gc(self, referenced, grace=86400):
+        # removes the documents whose path is not in referenced, stale staged
+        # files and symlinks left pointing at nothing; returns the bytes freed.
+        # Documents placed in the last grace seconds (by ctime, which linking
+        # and renaming update) are kept, they may belong to an add that has
+        # not committed yet.
+        freed = 0
+        cutoff = time.time() - grace
+        for directory, subdirs, files in os.walk(self.objects, topdown=False):
+            for name in files:
+                filename = os.path.join(directory, name)
+                if os.path.relpath(filename, self.root) not in referenced and \
+                        os.stat(filename).st_ctime < cutoff:
+                    freed += os.path.getsize(filename)
+                    os.remove(filename)
+            if directory != self.objects and not os.listdir(directory):
+                os.rmdir(directory)
+        if os.path.exists(self.tmp):
+            for name in os.listdir(self.tmp):
+                pid = name.split('-', 1)[0]
+                if pid.isdigit() and not _alive(int(pid)):
+                    freed += os.path.getsize(os.path.join(self.tmp, name))
+                    os.remove(os.path.join(self.tmp, name))
+        for view in self.VIEWS:
+            for directory, subdirs, files in os.walk(self.filename(view), topdown=False):
+                for name in files + subdirs:
+                    filename = os.path.join(directory, name)
+                    if os.path.islink(filename) and not os.path.exists(filename):
+                        os.remove(filename)
+                if not os.listdir(directory):
+                    os.rmdir(directory)
+        return freed
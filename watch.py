@@ -0,0 +1,151 @@
+# Copyright (C) 2012 Tai Chi Minh Ralph Eastwood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+EVENT_HEADER = struct.Struct('iIII')
+
+class Inotify(object):
+    # Linux inotify through libc, so no extra module is needed.
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.watches = {}
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        self.watches[wd] = path
+        return wd
+
+    def read(self, timeout=None):
+        # (directory, mask, name) of the events available within timeout
+        try:
+            ready = select.select([self.fd], [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        if not ready:
+            return []
+        data = os.read(self.fd, 65536)
+        events = []
+        i = 0
+        while i < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, i)
+            i += EVENT_HEADER.size
+            name = data[i:i + length].rstrip('\0')
+            i += length
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            events.append((self.watches.get(wd), mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class Watcher(object):
+    # Feeds documents that finish being written to, or are moved into, the
+    # watched directories through Kvasir.add. Events are debounced: a file is
+    # only added once it has been quiet for debounce seconds, and everything
+    # that became ready together goes through add as one batch, with the same
+    # Kvasir (and so the same index, extraction workers and lexicon) reused.
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, kvasir, directories, recursive=False, debounce=2.0,
+            extensions=('.pdf', '.ps'), **add_options):
+        self.kvasir = kvasir
+        self.recursive = recursive
+        self.debounce = debounce
+        self.extensions = extensions
+        self.add_options = add_options
+        self.pending = {}
+        self.inotify = Inotify()
+        for d in directories:
+            self.__watch(d)
+
+    def __watch(self, directory):
+        self.inotify.add_watch(directory, self.MASK)
+        if self.recursive:
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    self.__watch(path)
+
+    def __wanted(self, name):
+        return os.path.splitext(name)[1].lower() in self.extensions
+
+    def __ready(self):
+        now = time.time()
+        ready = sorted(p for p, t in self.pending.iteritems()
+            if now - t >= self.debounce)
+        for p in ready:
+            del self.pending[p]
+        return [p for p in ready if os.path.isfile(p)]
+
+    def run(self):
+        from ingest import walk
+        try:
+            while True:
+                timeout = self.debounce if self.pending else None
+                for directory, mask, name in self.inotify.read(timeout):
+                    if mask & IN_Q_OVERFLOW:
+                        print >> sys.stderr, 'warning: inotify queue overflowed, events were lost.'
+                        continue
+                    if directory is None:
+                        continue
+                    path = os.path.join(directory, name)
+                    if mask & IN_ISDIR:
+                        if self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                            self.__watch(path)
+                            # documents already in it by the time it is
+                            # watched (all of them for a directory moved in)
+                            # give no events of their own
+                            now = time.time()
+                            for p in walk(path, self.extensions):
+                                self.pending.setdefault(p, now)
+                    elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and self.__wanted(name):
+                        self.pending[path] = time.time()
+                ready = self.__ready()
+                if ready:
+                    self.kvasir.add(ready, **self.add_options)
+        finally:
+            self.inotify.close()
@@ -0,0 +1,124 @@
+# Copyright (C) 2012 Tai Chi Minh Ralph Eastwood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import time
+
+class BatchWriter(object):
+    # Accumulates documents in a whoosh writer and commits once a batch is
+    # full, by document count, approximate size in megabytes or age in seconds
+    # (a limit of 0 disables that trigger). Intermediate commits skip segment
+    # merging; close() does the merge once at the end of an import.
+    # on_commit(generation) runs after every commit and on_cancel() after a
+    # cancel, so that state kept outside the index can follow it.
+    def __init__(self, index, count=100, mb=0, seconds=0,
+            procs=1, limitmb=128, multisegment=False, on_commit=None,
+            on_cancel=None):
+        self.index = index
+        self.count = count
+        self.mb = mb
+        self.seconds = seconds
+        self.procs = procs
+        self.limitmb = limitmb
+        self.multisegment = multisegment
+        self.on_commit = on_commit
+        self.on_cancel = on_cancel
+        self.commits = 0
+        self.__writer = None
+        self.__reset()
+
+    def __reset(self):
+        self.pending = 0
+        self.pending_bytes = 0
+        self.started = None
+
+    def __open(self):
+        if self.__writer is None:
+            if self.procs > 1:
+                self.__writer = self.index.writer(procs=self.procs,
+                    limitmb=self.limitmb, multisegment=self.multisegment)
+            else:
+                self.__writer = self.index.writer(limitmb=self.limitmb)
+            self.started = time.time()
+        return self.__writer
+
+    def __full(self):
+        if self.count and self.pending >= self.count:
+            return True
+        if self.mb and self.pending_bytes >= self.mb * 1024 * 1024:
+            return True
+        if self.seconds and time.time() - self.started >= self.seconds:
+            return True
+        return False
+
+    def __queued(self, *documents):
+        # a group counts as one document against count, all of it against mb
+        self.pending += 1
+        for fields in documents:
+            for v in fields.itervalues():
+                if isinstance(v, basestring):
+                    self.pending_bytes += len(v)
+        if self.__full():
+            self.commit()
+
+    def add_document(self, **fields):
+        self.__open().add_document(**fields)
+        self.__queued(fields)
+
+    def update_document(self, **fields):
+        self.__open().update_document(**fields)
+        self.__queued(fields)
+
+    def add_group(self, documents):
+        # a parent followed by its children, kept next to each other as
+        # whoosh's nested queries expect (and never split across commits)
+        w = self.__open()
+        with w.group():
+            for fields in documents:
+                w.add_document(**fields)
+        self.__queued(*documents)
+
+    def delete_by_term(self, fieldname, text):
+        return self.__open().delete_by_term(fieldname, text)
+
+    def commit(self, merge=False, optimize=False):
+        if self.__writer is None:
+            return
+        self.__writer.commit(merge=merge, optimize=optimize)
+        self.__writer = None
+        self.commits += 1
+        self.__reset()
+        if self.on_commit is not None:
+            self.on_commit(self.index.latest_generation())
+
+    def cancel(self):
+        if self.__writer is not None:
+            self.__writer.cancel()
+            self.__writer = None
+        self.__reset()
+        if self.on_cancel is not None:
+            self.on_cancel()
+
+    def close(self, optimize=False):
+        # flush whatever is left and merge the segments written by the batches
+        if self.__writer is None and self.commits == 0 and not optimize:
+            return
+        self.__open()
+        self.commit(merge=True, optimize=optimize)
+        self.commits = 0